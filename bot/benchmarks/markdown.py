@@ -0,0 +1,42 @@
+"""Measures how many messages a second ext.markdown.format_content_html gets through.
+
+Run from the bot directory with python -m benchmarks.markdown.
+The corpus is the golden test inputs, which lean heavily on markdown, mixed with plain messages like most of a real archive."""
+
+import json, os
+
+from time import perf_counter
+
+from ext.markdown import format_content_html
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data", "format_content_html.json")
+PLAIN = "hey, did anyone see the game last night? it was great"
+
+ROUNDS = 5
+MESSAGES = 10000
+
+
+def run(messages):
+	started = perf_counter()
+
+	for content, allow_links in messages:
+		format_content_html(content, allow_links)
+
+	return perf_counter() - started
+
+def main():
+	with open(GOLDEN_PATH, encoding="utf-8") as file:
+		markdown = [(case["input"], case["allow_links"]) for case in json.load(file)]
+
+	corpora = {
+		"plain": [(PLAIN, True)] * MESSAGES,
+		"markdown": (markdown * (MESSAGES // len(markdown) + 1))[:MESSAGES],
+		"mixed": [markdown[i // 10 % len(markdown)] if i % 10 == 0 else (PLAIN, True) for i in range(MESSAGES)]
+	}
+
+	for name, messages in corpora.items():
+		best = min(run(messages) for _ in range(ROUNDS))
+		print(f"{name:>8}: {len(messages)} messages in {best:.3f}s, {len(messages) / best:,.0f} messages/s")
+
+if __name__ == "__main__":
+	main()
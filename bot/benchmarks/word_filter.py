@@ -0,0 +1,78 @@
+"""Compares ext.word_filter.WordFilter with the loop anti-curse used before it, which checked every word against every message.
+
+Run from the bot directory with python -m benchmarks.word_filter.
+Both are given the same blacklist and messages, a fixed seed keeps them the same between runs."""
+
+from random import Random
+from string import ascii_lowercase
+from time import perf_counter
+
+from ext.word_filter import WordFilter
+
+SEED = 6
+WORDS = 5000
+MESSAGES = 500
+ROUNDS = 5
+
+
+def make_corpus(random):
+	blacklist = ["".join(random.choice(ascii_lowercase) for _ in range(random.randint(4, 10))) for _ in range(WORDS)]
+
+	# roughly one message in five contains a blacklisted word, the rest are random text
+	messages = []
+	for i in range(MESSAGES):
+		words = ["".join(random.choice(ascii_lowercase) for _ in range(random.randint(2, 8))) for _ in range(random.randint(5, 40))]
+
+		if i % 5 == 0:
+			words.insert(random.randrange(len(words)), random.choice(blacklist))
+
+		messages.append(" ".join(words))
+
+	return blacklist, messages
+
+def old_loop(blacklist, messages):
+	flagged = []
+
+	for content in messages:
+		matched = False
+
+		for word in blacklist:
+			if word in content:
+				matched = True
+
+		flagged.append(matched)
+
+	return flagged
+
+def automaton(word_filter, messages):
+	return [word_filter.search(content) is not None for content in messages]
+
+def best_of(func, *args):
+	best, result = None, None
+
+	for _ in range(ROUNDS):
+		started = perf_counter()
+		result = func(*args)
+		elapsed = perf_counter() - started
+
+		best = elapsed if best is None else min(best, elapsed)
+
+	return best, result
+
+def main():
+	blacklist, messages = make_corpus(Random(SEED))
+
+	started = perf_counter()
+	word_filter = WordFilter(blacklist)
+	built = perf_counter() - started
+
+	old_time, old_flagged = best_of(old_loop, blacklist, messages)
+	new_time, new_flagged = best_of(automaton, word_filter, messages)
+
+	print(f"{WORDS} words, {MESSAGES} messages, best of {ROUNDS} runs")
+	print(f"   old loop: {old_time:.3f}s")
+	print(f"  automaton: {new_time:.3f}s (built in {built:.3f}s)")
+	print(f"    flagged: {sum(new_flagged)} messages, {'the same' if old_flagged == new_flagged else 'DIFFERENT'} as the old loop")
+
+if __name__ == "__main__":
+	main()
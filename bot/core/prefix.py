@@ -4,25 +4,90 @@ from discord import Message
 from discord.ext import commands
 
 default: str  = constants.PREFIX_DEFAULT
-aliases: list = constants.PREFIX_ALIASES
+aliases: tuple = tuple(constants.PREFIX_ALIASES)
 mention: bool = constants.PREFIX_MENTION
 
+
+class Matcher:
+	"""An immutable set of prefixes that can quickly find which one a message starts with.
+
+	Prefixes are grouped by their first character, so a message that can't start with any of them is rejected after a single lookup.
+	Longer prefixes are tried first so that, for example, "--" wins over "-"."""
+
+	def __init__(self, prefixes):
+		self.prefixes = tuple(sorted(dict.fromkeys(str(p) for p in prefixes if p), key=len, reverse=True))
+
+		by_first = {}
+		for p in self.prefixes:
+			by_first.setdefault(p[0], []).append(p)
+
+		self._by_first = {char: tuple(group) for char, group in by_first.items()}
+
+	def extend(self, prefixes):
+		"""Returns a new matcher with the extra prefixes added, this one is left untouched."""
+
+		if not prefixes:
+			return self
+
+		if isinstance(prefixes, str):
+			prefixes = prefixes,
+
+		return Matcher(self.prefixes + tuple(prefixes))
+
+	def match(self, content):
+		"""Returns the prefix that the content starts with or None if there isn't one."""
+
+		if not content:
+			return None
+
+		for p in self._by_first.get(content[0], ()):
+			if content.startswith(p):
+				return p
+
+		return None
+
+_base = None
+
 def all(bot: commands.Bot) -> list:
 	"""Returns a list of all possible prefixes."""
 
 	return [default, *aliases] + ([bot.user.mention] if mention else [])
 
-def processor(bot: commands.Bot,
-			  msg: Message) -> callable:
+def base(bot: commands.Bot) -> Matcher:
+	"""Returns the matcher for the prefixes that work everywhere.
+
+	It's built the first time it's needed since mention prefixes need the bot to be logged in."""
+
+	global _base
+
+	if _base is None:
+		mentions = (f"<@{bot.user.id}> ", f"<@!{bot.user.id}> ") if mention else ()
+		_base = Matcher((default, *aliases, *mentions))
+
+	return _base
+
+async def for_guild(bot: commands.Bot,
+					guild) -> Matcher:
+	"""Returns the matcher for a guild, which includes any custom prefixes set in its config.
+
+	It's compiled alongside the guild's config so it's only rebuilt when the config changes."""
+
+	matcher = base(bot)
+
+	if guild is None:
+		return matcher
+
+	return await bot.get_compiled(guild, Matcher, lambda config: matcher.extend(config.get("prefixes")))
+
+async def processor(bot: commands.Bot,
+					msg: Message) -> tuple:
 	"""This is what gets forwarded to command_prefix in the core."""
 
-	prefixes = aliases
-	prefixes.insert(0, default)
-	
-	if mention:
-		if isinstance(prefixes, str):
-			prefixes = prefixes,
+	matcher = await for_guild(bot, msg.guild)
 
-		return commands.when_mentioned_or(*prefixes)(bot, msg)
+	# handing back just the prefix that matched saves discord.py from trying them all again
+	matched = matcher.match(msg.content)
+	if matched is not None:
+		return matched,
 
-	return prefixes
\ No newline at end of file
+	return matcher.prefixes
\ No newline at end of file
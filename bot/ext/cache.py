@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class ConfigCache:
+	"""A bounded, per-guild cache of parsed guild configs.
+
+	Entries are evicted in least-recently-used order once the cache is full and expire after ttl seconds,
+	so a missed invalidation can only ever leave a config stale for a short while.
+	Each entry also holds the objects compiled from its config, so they're dropped along with it."""
+
+	def __init__(self, size=1000, ttl=300):
+		self.size = size
+		self.ttl = ttl
+
+		self._entries = OrderedDict()
+
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.coalesced = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, guild_id):
+		"""Returns the cached config for a guild or None if there isn't a fresh one."""
+
+		entry = self._entries.get(guild_id)
+
+		if entry is None or entry[1] <= monotonic():
+			self._entries.pop(guild_id, None)
+			self.misses += 1
+
+			return None
+
+		self._entries.move_to_end(guild_id)
+		self.hits += 1
+
+		return entry[0]
+
+	def compiled(self, guild_id, config):
+		"""Returns the dict of objects compiled from a guild's cached config.
+
+		Returns None if config isn't the one that's cached, in which case whatever is built from it can't be kept."""
+
+		entry = self._entries.get(guild_id)
+
+		if entry is None or entry[0] is not config:
+			return None
+
+		return entry[2]
+
+	def drop_compiled(self, guild_id):
+		"""Forgets the objects compiled from a guild's config without dropping the config itself."""
+
+		entry = self._entries.get(guild_id)
+
+		if entry is not None:
+			entry[2].clear()
+
+	def set(self, guild_id, config):
+		"""Caches a guild's config, evicting the least recently used entry if the cache is full."""
+
+		self._entries[guild_id] = config, monotonic() + self.ttl, {}
+		self._entries.move_to_end(guild_id)
+
+		while len(self._entries) > self.size:
+			self._entries.popitem(last=False)
+
+	def invalidate(self, guild_id=None):
+		"""Removes a guild's config from the cache.
+
+		If no guild_id is provided, the entire cache is wiped."""
+
+		if guild_id is None:
+			self._entries.clear()
+
+		else:
+			self._entries.pop(guild_id, None)
+
+		self.invalidations += 1
+
+	@property
+	def stats(self):
+		return {
+			"size": len(self),
+			"hits": self.hits,
+			"misses": self.misses,
+			"invalidations": self.invalidations,
+			"coalesced": self.coalesced
+		}
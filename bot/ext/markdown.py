@@ -0,0 +1,108 @@
+import html, re
+
+
+CODEBLOCK_REGEX = re.compile(r"```+((?:[^`]*?\n)?(?:[^`]+))\n?```+")
+CODEBLOCK_BODY_REGEX = re.compile(r"^([^`]*?\n)?([^`]+)$")
+INLINE_CODEBLOCK_REGEX = re.compile(r"`([^`]+)`")
+LINK_REGEX = re.compile(r"\[(.*?)\]\((.*?)\)")
+URL_REGEX = re.compile(r"(\b(?:(?:https?|ftp|file)://|www\.|ftp\.)(?:\([-a-zA-Z0-9+&@#/%?=~_|!:,\.\[\];]*\)|[-a-zA-Z0-9+&@#/%?=~_|!:,\.\[\];])*(?:\([-a-zA-Z0-9+&@#/%?=~_|!:,\.\[\];]*\)|[-a-zA-Z0-9+&@#/%=~_|$]))")
+PLACEHOLDER_REGEX = re.compile(r"\x1A([MILU])(\d+)\x1A\1")
+
+# (marker that has to be present for the pattern to match, pattern, replacement)
+STYLES = (
+	("**", re.compile(r"(\*\*)(?=\S)(.+?[*_]*)(?<=\S)\1"), r"<b>\2</b>"),
+	("__", re.compile(r"(__)(?=\S)(.+?)(?<=\S)\1"), r"<u>\2</u>"),
+	(None, re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1"), r"<i>\2</i>"),
+	("~~", re.compile(r"(~~)(?=\S)(.+?)(?<=\S)\1"), r"<s>\2</s>")
+)
+
+MENTION_REGEX = re.compile(r"&lt;(?:@!?|#|@&amp;)\d+&gt;")
+EMOJI_REGEX = re.compile(r"&lt;(:.*?:)(\d*)&gt;")
+ANIMATED_EMOJI_REGEX = re.compile(r"&lt;(a:.*?:)(\d*)&gt;")
+
+# the majority of this function was "borrowed" from kyb3r's modmail logviewer
+# https://github.com/kyb3r/logviewer/blob/master/core/formatter.py
+def format_content_html(content, allow_links=False):
+	"""Converts the subset of markdown that Discord supports into HTML.
+
+	Code blocks, links and URLs are swapped out for placeholders that point into a list so that the styling passes can't touch them, then they're all put back in a single pass at the end.
+	Each pass is only run if the text contains the characters it needs to match, which means that most messages skip the majority of them."""
+
+	fragments = []
+
+	def protect(kind, value):
+		fragments.append(value)
+
+		return f"\x1A{kind}{len(fragments) - 1}\x1A{kind}"
+
+	# Stray placeholder characters would otherwise be mistaken for real placeholders
+	content = content.replace("\x1A", "")
+
+	# Encode multiline codeblocks (```text```)
+	if "```" in content:
+		content = CODEBLOCK_REGEX.sub(lambda m: protect("M", m.group(1)), content)
+
+	content = html.escape(content)
+
+	# Encode inline codeblocks (`text`)
+	if "`" in content:
+		content = INLINE_CODEBLOCK_REGEX.sub(lambda m: protect("I", m.group(1)), content)
+
+	# Encode links
+	if allow_links and "](" in content:
+		content = LINK_REGEX.sub(lambda m: protect("L", m.group(1, 2)), content)
+
+	# Encode URLs
+	if "://" in content or "www." in content or "ftp." in content:
+		content = URL_REGEX.sub(lambda m: protect("U", m.group(1)), content)
+
+	# Process bold (**text**), underline (__text__), italic (*text* or _text_) and strike through (~~text~~)
+	if "*" in content or "_" in content or "~~" in content:
+		for marker, pattern, replacement in STYLES:
+			if marker is None or marker in content:
+				content = pattern.sub(replacement, content)
+
+	# Process new lines
+	content = content.replace("\n", "<br>")
+
+	def decode(m):
+		kind, value = m.group(1), fragments[int(m.group(2))]
+
+		if kind == "M":
+			match = CODEBLOCK_BODY_REGEX.match(value)
+
+			return f"<div class='codeblock'>{html.escape(match.group(2))}</div>"
+
+		# inline codeblocks and links can have placeholders of their own inside them
+		if kind == "I":
+			value = PLACEHOLDER_REGEX.sub(decode, value.replace("\n", "<br>"))
+
+			return f"<span class='inline-codeblock'>{value}</span>"
+
+		if kind == "L":
+			text, url = (PLACEHOLDER_REGEX.sub(decode, part) for part in value)
+
+			return f"<a href='{url}'>{text}</a>"
+
+		return f"<a class='link' href='{value}'>{value}</a>"
+
+	# Decode and process codeblocks, links and URLs
+	if fragments:
+		content = PLACEHOLDER_REGEX.sub(decode, content)
+
+	# Meta mentions (@everyone and @here)
+	if "@" in content:
+		content = content.replace("@everyone", "<span class='mention'>@everyone</span>")
+		content = content.replace("@here", "<span class='mention'>@here</span>")
+
+	if "&lt;" in content:
+		# User (<@id> and <@!id>), channel (<#id>) and role (<@&id>) mentions
+		content = MENTION_REGEX.sub(r"<span class='mention'>\g<0></span>", content)
+
+		# Custom emojis (<:name:id>)
+		content = EMOJI_REGEX.sub(r"<img class='emoji' src='https://cdn.discordapp.com/emojis/\2.png'>", content)
+
+		# Custom animated emojis (<a:name:id>)
+		content = ANIMATED_EMOJI_REGEX.sub(r"<img class='emoji' src='https://cdn.discordapp.com/emojis/\2.gif'>", content)
+
+	return content
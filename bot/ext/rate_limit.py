@@ -0,0 +1,80 @@
+from collections import deque
+from itertools import count
+from math import ceil
+from time import monotonic, time
+
+
+class LocalLimiter:
+	"""Counts hits per key over a sliding window, entirely in memory.
+
+	Each key keeps a ring buffer of its most recent hit times, which is only ever as long as the limit it's checked against.
+	Keys that haven't been hit for longer than their window are swept away every sweep_interval seconds.
+	This only works when there's a single bot process, use RedisLimiter otherwise."""
+
+	def __init__(self, sweep_interval=60):
+		self.sweep_interval = sweep_interval
+
+		self._hits = {}
+		self._last_sweep = monotonic()
+
+	async def hit(self, key, limit, window):
+		"""Records a hit and returns how many hits the key has had in the last window seconds, capped at limit."""
+
+		now = monotonic()
+		entry = self._hits.get(key)
+
+		hits = entry[0] if entry is not None and entry[0].maxlen == limit else deque(maxlen=limit)
+		while hits and hits[0] <= now - window:
+			hits.popleft()
+
+		hits.append(now)
+		self._hits[key] = hits, window
+
+		if now - self._last_sweep >= self.sweep_interval:
+			self.sweep(now)
+
+		return len(hits)
+
+	def sweep(self, now=None):
+		"""Forgets every key whose most recent hit has fallen out of its window."""
+
+		now = now or monotonic()
+
+		for key in [k for k, (hits, window) in self._hits.items() if hits[-1] <= now - window]:
+			del self._hits[key]
+
+		self._last_sweep = now
+
+class RedisLimiter:
+	"""Counts hits per key over a sliding window using a Redis sorted set, so it can be shared between processes.
+
+	The client is looked up from the bot on each hit since the Redis plugin may be loaded after whatever creates this."""
+
+	def __init__(self, bot):
+		self.bot = bot
+
+		self._sequence = count()
+
+	async def hit(self, key, limit, window):
+		"""Records a hit and returns how many hits the key has had in the last window seconds, capped at limit."""
+
+		now = time()
+
+		async with self.bot.redis.pipeline(transaction=True) as pipe:
+			pipe.zremrangebyscore(key, 0, now - window)
+			pipe.zadd(key, {f"{now}:{next(self._sequence)}": now})
+			pipe.zremrangebyrank(key, 0, -limit - 1)
+			pipe.zcard(key)
+			pipe.expire(key, ceil(window))
+
+			*_, hits, _ = await pipe.execute()
+
+		return hits
+
+def new(bot):
+	"""Creates the rate limiter backend chosen by the rate_limiter option in the bot's config."""
+
+	if bot.config.get("rate_limiter", "redis") == "local":
+		return LocalLimiter()
+
+	return RedisLimiter(bot)
@@ -1,2 +1,4 @@
 access_control = None
+auto_mod = None
+log_dispatcher = None
 timer_handler = None
\ No newline at end of file
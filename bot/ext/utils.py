@@ -205,5 +205,20 @@ def clean_user(guild, user_id):
 
 	return user_id
 
+def shards(bot):
+	"""Returns the shard count and the IDs of the shards this process is running.
+
+	Rows tied to a guild are split between processes by the guild's shard, (guild_id >> 22) % shard_count."""
+
+	shard_ids = getattr(bot, "shard_ids", None) or [bot.shard_id or 0]
+	return bot.shard_count or 1, list(shard_ids)
+
+def int_keys(pairs):
+	"""An object_pairs_hook for json.loads that turns numeric keys back into ints.
+
+	Guild configs key things like channels and roles by ID but they're stored as JSON, which only allows string keys."""
+
+	return {int(k) if k.isdecimal() else k: v for k, v in pairs}
+
 def fmt_prefix(command):
 	return prefix.default + command
\ No newline at end of file
@@ -0,0 +1,116 @@
+class WordFilter:
+	"""Finds every occurrence of a list of words in a piece of text using an Aho-Corasick automaton.
+
+	The automaton is built once from the word list and then scans text in a single pass, so the cost of a scan depends on the
+	length of the text rather than the number of words being looked for.
+
+	If ignore_case is True, both the words and the text are casefolded before matching.
+	If whole_words is True, a match only counts if it isn't surrounded by other letters, digits or underscores."""
+
+	def __init__(self, words, ignore_case=False, whole_words=False):
+		self.ignore_case = ignore_case
+		self.whole_words = whole_words
+
+		# state 0 is the root, each state has its transitions, failure link and the words that end there
+		self._goto = [{}]
+		self._fail = [0]
+		self._output = [()]
+
+		for word in words:
+			self._add(str(word))
+
+		self._link()
+
+	def __bool__(self):
+		return len(self._goto) > 1
+
+	def _add(self, word):
+		if self.ignore_case:
+			word = word.casefold()
+
+		if not word:
+			return
+
+		state = 0
+		for char in word:
+			next_state = self._goto[state].get(char)
+
+			if next_state is None:
+				next_state = self._goto[state][char] = len(self._goto)
+
+				self._goto.append({})
+				self._fail.append(0)
+				self._output.append(())
+
+			state = next_state
+
+		if word not in self._output[state]:
+			self._output[state] += word,
+
+	def _link(self):
+		"""Builds the failure links breadth-first, merging in the words of each state's fallback."""
+
+		queue = list(self._goto[0].values())
+
+		for state in queue:
+			for char, next_state in self._goto[state].items():
+				fallback = self._fail[state]
+
+				while fallback and char not in self._goto[fallback]:
+					fallback = self._fail[fallback]
+
+				self._fail[next_state] = self._goto[fallback].get(char, 0)
+				self._output[next_state] += self._output[self._fail[next_state]]
+
+				queue.append(next_state)
+
+	@staticmethod
+	def _is_word_char(char):
+		return char.isalnum() or char == "_"
+
+	def _bounded(self, text, start, end):
+		if start > 0 and self._is_word_char(text[start - 1]):
+			return False
+
+		if end < len(text) and self._is_word_char(text[end]):
+			return False
+
+		return True
+
+	def _scan(self, text):
+		if self.ignore_case:
+			text = text.casefold()
+
+		goto = self._goto
+		fail = self._fail
+		output = self._output
+
+		state = 0
+		for index, char in enumerate(text):
+			while state and char not in goto[state]:
+				state = fail[state]
+
+			state = goto[state].get(char, 0)
+
+			for word in output[state]:
+				start = index - len(word) + 1
+
+				if self.whole_words and not self._bounded(text, start, index + 1):
+					continue
+
+				yield start, word
+
+	def find_all(self, text):
+		"""Returns a list of (position, word) tuples for every match in the text, in the order they appear.
+
+		Positions refer to the casefolded text when ignore_case is enabled."""
+
+		return list(self._scan(text))
+
+	def search(self, text):
+		"""Returns the first word found in the text or None if there aren't any matches."""
+
+		for _, word in self._scan(text):
+			return word
+
+		return None
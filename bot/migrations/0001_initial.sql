@@ -0,0 +1,7 @@
+-- the schema as it was before migrations existed, every statement is safe to run against an existing database
+
+CREATE TABLE IF NOT EXISTS infractions (id SERIAL PRIMARY KEY, guild_id BIGINT, actor_id BIGINT, target_id BIGINT, type_id BIGINT, reason TEXT, created_at TIMESTAMP);
+CREATE TABLE IF NOT EXISTS timers (id SERIAL PRIMARY KEY, event TEXT, expire_at TIMESTAMP, extras JSONB);
+CREATE TABLE IF NOT EXISTS persistent_roles (id SERIAL PRIMARY KEY, user_id BIGINT, guild_id BIGINT, role_ids TEXT, CONSTRAINT unique_user_guild UNIQUE (user_id, guild_id));
+CREATE TABLE IF NOT EXISTS starboard_messages (id SERIAL PRIMARY KEY, guild_id BIGINT, starboard_id BIGINT, channel_id BIGINT, message_id BIGINT, created_at TIMESTAMP);
+CREATE TABLE IF NOT EXISTS message_archives (id SERIAL PRIMARY KEY, cdn_url TEXT, key TEXT);
@@ -0,0 +1,8 @@
+-- timers are paged in by expiry, looked up by their extras and leased to a single bot process
+
+ALTER TABLE timers ADD COLUMN IF NOT EXISTS guild_id BIGINT, ADD COLUMN IF NOT EXISTS lease_owner TEXT, ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP;
+UPDATE timers SET guild_id = (extras->>'guild_id')::BIGINT WHERE guild_id IS NULL AND extras ? 'guild_id';
+
+CREATE INDEX IF NOT EXISTS timers_expire_at_idx ON timers (expire_at);
+CREATE INDEX IF NOT EXISTS timers_lease_owner_idx ON timers (lease_owner);
+CREATE INDEX IF NOT EXISTS timers_extras_idx ON timers USING GIN (extras jsonb_path_ops);
@@ -0,0 +1,8 @@
+-- inf recent and inf search page through a guild's infractions newest first
+CREATE INDEX IF NOT EXISTS infractions_guild_id_idx ON infractions (guild_id, id DESC);
+CREATE INDEX IF NOT EXISTS infractions_target_id_idx ON infractions (target_id, guild_id, id DESC);
+CREATE INDEX IF NOT EXISTS infractions_actor_id_idx ON infractions (actor_id, guild_id, id DESC);
+CREATE INDEX IF NOT EXISTS infractions_created_at_idx ON infractions (guild_id, created_at);
+
+-- every starboard update looks up the starboard copy of the message that was reacted to
+CREATE INDEX IF NOT EXISTS starboard_messages_message_idx ON starboard_messages (guild_id, message_id, channel_id);
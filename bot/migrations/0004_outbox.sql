@@ -0,0 +1,15 @@
+-- log lines and DMs waiting to be delivered when log_dispatcher.outbox is enabled
+
+CREATE TABLE IF NOT EXISTS outbox (
+	id BIGSERIAL PRIMARY KEY,
+	kind TEXT NOT NULL,
+	guild_id BIGINT,
+	destination BIGINT NOT NULL,
+	content TEXT NOT NULL,
+	fallback JSONB,
+	attempts INT NOT NULL DEFAULT 0,
+	created_at TIMESTAMP NOT NULL,
+	next_attempt_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS outbox_next_attempt_at_idx ON outbox (next_attempt_at, id);
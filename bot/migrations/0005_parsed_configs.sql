@@ -0,0 +1,5 @@
+-- the dashboard stores a pre-parsed copy of each config, but the bot may be started against a database it hasn't touched yet
+-- configs saved before the column existed are parsed by the bot until the dashboard backfills them
+
+CREATE TABLE IF NOT EXISTS guild_configs (id BIGINT UNIQUE, config TEXT);
+ALTER TABLE guild_configs ADD COLUMN IF NOT EXISTS parsed JSONB;
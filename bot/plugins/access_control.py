@@ -16,18 +16,20 @@ class Level:
 
 class Config:
 	def __init__(self, guild, config):
-		self.levels = [Level(guild, r, **options) for r, options in config.get("access_control", {}).items()]
+		levels = [Level(guild, r, **options) for r, options in config.get("access_control", {}).items()]
+
+		# keyed by role ID so a member's levels can be found without scanning every configured level
+		self.levels = {l.role.id: l for l in levels if l.role is not None}
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(guild, config))
 
 	def can_use(self, member, command, needed_level):
 		if member.guild_permissions.administrator:
 			return True
 
-		all_levels = [l for l in self.levels if l.role in member.roles]
+		all_levels = [self.levels[r.id] for r in member.roles if r.id in self.levels]
 
 		if not all_levels:
 			return False
@@ -69,6 +71,14 @@ class Plugin(commands.Cog):
 
 		return commands.check(predicate)
 
+	async def has_level(self, ctx, level):
+		"""Returns whether the author can use the current command at a level other than the one it requires.
+		
+		This is for commands that need more access for some uses than others."""
+
+		config = await Config.new(self.bot, ctx.guild)
+		return config.can_use(ctx.author, ctx.command, level)
+
 
 def setup(bot):
 	ext.state.access_control = cog = Plugin(bot)
@@ -1,128 +1,16 @@
-import base64, discord, html, re
+import base64, discord
 
 from datetime import datetime
 from discord.ext import commands
 from ext.utils import bytes_4_humans, identifier
-from os import remove
+from io import BytesIO
 
 from ext.exceptions import MissingSubcommand
+from ext.markdown import format_content_html
 from ext.state import access_control
 
-# the majority of this function was "borrowed" from kyb3r's modmail logviewer
-# https://github.com/kyb3r/logviewer/blob/master/core/formatter.py
-def format_content_html(content, allow_links=False):
-	def encode_codeblock(m):
-		encoded = base64.b64encode(m.group(1).encode()).decode()
-
-		return f"\x1AM{encoded}\x1AM"
-
-	# Encode multiline codeblocks (```text```)
-	content = re.sub(r"```+((?:[^`]*?\n)?(?:[^`]+))\n?```+", encode_codeblock, content)
-	content = html.escape(content)
-
-	def encode_inline_codeblock(m):
-		encoded = base64.b64encode(m.group(1).encode()).decode()
-
-		return f"\x1AI{encoded}\x1AI"
-
-	# Encode inline codeblocks (`text`)
-	content = re.sub(r"`([^`]+)`", encode_inline_codeblock, content)
-
-	# Encode links
-	if allow_links:
-		def encode_link(m):
-			encoded_1 = base64.b64encode(m.group(1).encode()).decode()
-			encoded_2 = base64.b64encode(m.group(2).encode()).decode()
-
-			return f"\x1AL{encoded_1}|{encoded_2}\x1AL"
-
-		content = re.sub(r"\[(.*?)\]\((.*?)\)", encode_link, content)
-
-	def encode_url(m):
-		encoded = base64.b64encode(m.group(1).encode()).decode()
-
-		return f"\x1AU{encoded}\x1AU"
-
-	# Encode URLs
-	content = re.sub(r"(\b(?:(?:https?|ftp|file)://|www\.|ftp\.)(?:\([-a-zA-Z0-9+&@#/%?=~_|!:,\.\[\];]*\)|[-a-zA-Z0-9+&@#/%?=~_|!:,\.\[\];])*(?:\([-a-zA-Z0-9+&@#/%?=~_|!:,\.\[\];]*\)|[-a-zA-Z0-9+&@#/%=~_|$]))", encode_url, content)
-
-	# Process bold (**text**)
-	content = re.sub(r"(\*\*)(?=\S)(.+?[*_]*)(?<=\S)\1", r"<b>\2</b>", content)
-
-	# Process underline (__text__)
-	content = re.sub(r"(__)(?=\S)(.+?)(?<=\S)\1", r"<u>\2</u>", content)
-
-	# Process italic (*text* or _text_)
-	content = re.sub(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", r"<i>\2</i>", content)
-
-	# Process strike through (~~text~~)
-	content = re.sub(r"(~~)(?=\S)(.+?)(?<=\S)\1", r"<s>\2</s>", content)
-
-	def decode_inline_codeblock(m):
-		decoded = base64.b64decode(m.group(1).encode()).decode()
-
-		return f"<span class='inline-codeblock'>{decoded}</span>"
-
-	# Decode and process inline codeblocks
-	content = re.sub(r"\x1AI(.*?)\x1AI", decode_inline_codeblock, content)
-
-	# Decode and process links
-	if allow_links:
-		def decode_link(m):
-			encoded_1 = base64.b64decode(m.group(1).encode()).decode()
-			encoded_2 = base64.b64decode(m.group(2).encode()).decode()
-
-			return f"<a href='{encoded_2}'>{encoded_1}</a>"
-
-		# Potential bug, may need to change to: '\x1AL(.*?)\|(.*?)\x1AL'
-		content = re.sub(r"\x1AL(.*?)\|(.*?)\x1AL", decode_link, content)
-
-	def decode_url(m):
-		decoded = base64.b64decode(m.group(1).encode()).decode()
-
-		return f"<a class='link' href='{decoded}'>{decoded}</a>"
-
-	# Decode and process URLs
-	content = re.sub("\x1AU(.*?)\x1AU", decode_url, content)
-
-	# Process new lines
-	content = content.replace("\n", "<br>")
-
-	def decode_codeblock(m):
-		decoded = base64.b64decode(m.group(1).encode()).decode()
-		match = re.match(r"^([^`]*?\n)?([^`]+)$", decoded)
-
-		result = html.escape(match.group(2))
-		return f"<div class='codeblock'>{result}</div>"
-
-	# Decode and process multiline codeblocks
-	content = re.sub("\x1AM(.*?)\x1AM", decode_codeblock, content)
-
-	# Meta mentions (@everyone and @here)
-	content = content.replace("@everyone", "<span class='mention'>@everyone</span>")
-	content = content.replace("@here", "<span class='mention'>@here</span>")
-
-	# User mentions (<@id> and <@!id>)
-	content = re.sub(r"(&lt;@!?(\d+)&gt;)", r"<span class='mention'>\1</span>", content)
-
-	# Channel mentions (<#id>)
-	content = re.sub(r"(&lt;#\d+&gt;)", r"<span class='mention'>\1</span>", content)
-
-	# Role mentions (<@&id>)
-	content = re.sub(r"(&lt;@&amp;(\d+)&gt;)", r"<span class='mention'>\1</span>", content)
-
-	# Custom emojis (<:name:id>)
-	content = re.sub(r"&lt;(:.*?:)(\d*)&gt;", r"<img class='emoji' src='https://cdn.discordapp.com/emojis/\2.png'>", content)
-
-	# Custom animated emojis (<a:name:id>)
-	content = re.sub(r"&lt;(a:.*?:)(\d*)&gt;", r"<img class='emoji' src='https://cdn.discordapp.com/emojis/\2.gif'>", content)
-
-	return content
-
-def encode(text):
-	as_bytes = text.encode("utf-8")
-	as_b64_bytes = base64.b64encode(as_bytes)
-	return as_b64_bytes.decode("utf-8")
+# must be a multiple of 3 so that the encoded chunks can be joined without any padding in between
+RAW_CHUNK_SIZE = 3 * 16384
 
 class Plugin(commands.Cog, name="Message Archiving"):
 	"""Should you need to keep a record of messages that were sent but also need to clear them from chat, you can use these commands to create a file and save it for later.
@@ -215,16 +103,11 @@ class Plugin(commands.Cog, name="Message Archiving"):
 			key = identifier("%A%A%A%A-%A%A%A%A-%A%A%A%A")
 			id = await con.fetchval(query, key)
 
-		with open(f"buffer-archive:{key}.html", "w", encoding="utf-8") as file:
-			file.write(self.make_html(ctx, id, messages))
-
 		msg = await ctx.success(content,
-			file=discord.File(f"buffer-archive:{key}.html",
+			file=discord.File(self.make_html(ctx, id, messages),
 				filename=f"Archive_{key}.html"
 			)
 		)
-		
-		remove(f"buffer-archive:{key}.html")
 
 		async with self.bot.postgres.acquire() as con:
 			query = """UPDATE message_archives SET cdn_url = $1 WHERE id = $2;"""
@@ -232,39 +115,28 @@ class Plugin(commands.Cog, name="Message Archiving"):
 			await con.execute(query, msg.attachments[0].url, id)
 
 	def make_html(self, ctx, id, messages):
+		"""Renders an archive into an in-memory buffer that can be handed straight to discord.File.
+
+		The document is written out a piece at a time instead of being built up as one string, so rendering takes time and memory linear in the number of messages.
+		The plain text copy sits above the entries in the page, so it's written to its own buffer first and then base64 encoded into the document in chunks."""
+
 		TIMESTAMP_FORMAT = "%d/%m/%y at %H:%M"
 		RAW_TIMESTAMP_FORMAT = "%d-%m-%y %H:%M"
 
 		IMAGE_EXTENSIONS = ".png", ".jpg", ".jpeg", ".webp", ".svg"
 
-		message_string = ""
-		raw_text = ""
+		messages = [m for m in messages if m.content or m.attachments]
+		raw_text = BytesIO()
 
 		for m in messages:
-			if not m.content and not m.attachments:
-				continue
-
-			attachments = ""
+			raw_text.write(f"{m.created_at.strftime(RAW_TIMESTAMP_FORMAT)} ({ctx.guild.id} / {m.channel.id} / {m.author.id} / {m.id}) {m.author}: {m.clean_content}\n".encode("utf-8"))
 
-			for a in m.attachments:
-				if a.url.endswith(IMAGE_EXTENSIONS):
-					attachments += f"<a href='{a.url}'><img class='archive-attachment' src='{a.url}'></a>"
+		buffer = BytesIO()
 
-				else:
-					attachments += f"<div class='archive-attachment-box'><a href='{a.url}' class='archive-attachment-name'>{a.filename}</a><p class='archive-attachment-size'>{bytes_4_humans(a.size)}</p></div>"
+		def write(text):
+			buffer.write(text.encode("utf-8"))
 
-			message_string += f"""
-				<div class="archive-entry">
-					<span class="archive-username">{m.author}</span>
-					<span class="archive-timestamp">{m.created_at.strftime(TIMESTAMP_FORMAT)}</span>
-					<p>{format_content_html(m.content, True)}</p>
-					{attachments}
-				</div>
-			"""
-
-			raw_text += f"{m.created_at.strftime(RAW_TIMESTAMP_FORMAT)} ({ctx.guild.id} / {m.channel.id} / {m.author.id} / {m.id}) {m.author}: {m.clean_content}\n"
-
-		return f"""
+		write(f"""
 			<!DOCTYPE html>
 			<html>
 			<head>
@@ -299,18 +171,48 @@ class Plugin(commands.Cog, name="Message Archiving"):
 			</head>
 			<body>
 				<h2 class="archive-title">Archive #{id}</h2>
-				<a class="archive-download" id="download-button" href="data:text/plain;charset=utf-8;base64,{encode(raw_text)}" download="Archive_{id}.txt">
+				<a class="archive-download" id="download-button" href="data:text/plain;charset=utf-8;base64,""")
+
+		with raw_text.getbuffer() as view:
+			for i in range(0, len(view), RAW_CHUNK_SIZE):
+				buffer.write(base64.b64encode(view[i:i + RAW_CHUNK_SIZE]))
+
+		write(f"""\" download="Archive_{id}.txt">
 					<i class="fas fa-download"></i>
 				</a>
 				<p class="archive-timestamp">Created by {ctx.author} at {datetime.utcnow().strftime(TIMESTAMP_FORMAT)}</p>
 				<hr>
 
 				<div class="archive-entries">
-					{message_string}
+					""")
+
+		for m in messages:
+			attachments = ""
+
+			for a in m.attachments:
+				if a.url.endswith(IMAGE_EXTENSIONS):
+					attachments += f"<a href='{a.url}'><img class='archive-attachment' src='{a.url}'></a>"
+
+				else:
+					attachments += f"<div class='archive-attachment-box'><a href='{a.url}' class='archive-attachment-name'>{a.filename}</a><p class='archive-attachment-size'>{bytes_4_humans(a.size)}</p></div>"
+
+			write(f"""
+				<div class="archive-entry">
+					<span class="archive-username">{m.author}</span>
+					<span class="archive-timestamp">{m.created_at.strftime(TIMESTAMP_FORMAT)}</span>
+					<p>{format_content_html(m.content, True)}</p>
+					{attachments}
+				</div>
+			""")
+
+		write("""
 				</div>
 			</body>
 			</html>
-		"""
+		""")
+
+		buffer.seek(0)
+		return buffer
 
 def setup(bot):
 	bot.add_cog(Plugin(bot))
\ No newline at end of file
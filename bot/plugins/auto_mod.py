@@ -1,12 +1,24 @@
 import re
 
-from discord.ext import commands
+import ext.rate_limit as rate_limit
+import ext.state
 
+from asyncio import current_task, shield
+from discord.ext import commands, tasks
+from time import monotonic, perf_counter
+
+from ext.word_filter import WordFilter
 from plugins.infractions import Handler as InfractionHandler
 
+# how often cached invites are re-fetched, guilds that haven't needed theirs since the last refresh are forgotten instead
+INVITE_REFRESH = 1800
+
+INVITE_REGEX = re.compile(r"(?:https?://)?(?:www\.)?(?:discord\.gg|discord\.com/invite)/([a-z0-9-]+)", re.IGNORECASE)
+
 
 class ConfigMixin:
 	def __init__(self, bot, guild, config, handler):
+		self.guild = guild
 		self._handler = handler
 
 		self.enabled = config.get("enabled", False)
@@ -20,8 +32,8 @@ class ConfigMixin:
 			4: None
 		}.get(config.get("action", None))
 
-		self.ignored_roles = list(filter(None, [guild.get_role(r) for r in config.get("ignored_roles", [])]))
-		self.ignored_channels = list(filter(None, [guild.get_channel(c) for c in config.get("ignored_channels", [])]))
+		self.ignored_roles = set(config.get("ignored_roles", []))
+		self.ignored_channels = set(config.get("ignored_channels", []))
 
 	async def respond(self, user, reason):
 		AVAILABLE_TEMP_RESPONSES = self._handler.ban, self._handler.mute
@@ -36,14 +48,11 @@ class ConfigMixin:
 			return await self._response(self.guild.me, user, reason)
 
 	def is_ignored(self, user, channel):
-		if channel in self.ignored_channels:
+		if channel.id in self.ignored_channels:
 			return True
 
-		for r in self.ignored_roles:
-			if r in user.roles:
-				return True
-
-		return False
+		# webhook messages are sent by users that don't have any roles
+		return bool(self.ignored_roles) and any(r.id in self.ignored_roles for r in getattr(user, "roles", ()))
 
 class CountMixin:
 	def __init__(self, config):
@@ -57,12 +66,6 @@ class SpamConfig(ConfigMixin, CountMixin):
 		ConfigMixin.__init__(self, bot, guild, raw, handler)
 		CountMixin.__init__(self, raw)
 
-	@classmethod
-	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		handler = await InfractionHandler.new(bot, guild)
-		return cls(bot, guild, config, handler)
-
 class PingSpamConfig(ConfigMixin, CountMixin):
 	def __init__(self, bot, guild, config, handler):
 		raw = config.get("anti_ping_spam", {})
@@ -70,37 +73,34 @@ class PingSpamConfig(ConfigMixin, CountMixin):
 		ConfigMixin.__init__(self, bot, guild, raw, handler)
 		CountMixin.__init__(self, raw)
 	
-	@classmethod
-	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		handler = await InfractionHandler.new(bot, guild)
-		return cls(bot, guild, config, handler)
-
 class CurseConfig(ConfigMixin):
 	def __init__(self, bot, guild, config, handler):
 		raw = config.get("anti_curse", {})
-		self.blacklist = raw.get("blacklist", [])
+		self.blacklist = WordFilter(raw.get("blacklist", []),
+			ignore_case=raw.get("ignore_case", False),
+			whole_words=raw.get("whole_words", False)
+		)
 
 		ConfigMixin.__init__(self, bot, guild, raw, handler)
 
-	@classmethod
-	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		handler = await InfractionHandler.new(bot, guild)
-		return cls(bot, guild, config, handler)
-
 class InviteConfig(ConfigMixin):
 	def __init__(self, bot, guild, config, handler):
 		raw = config.get("anti_invite", {})
-		self.whitelist = raw.get("whitelist", [])
+		self.whitelist = {str(code).lower() for code in raw.get("whitelist", [])}
 
 		ConfigMixin.__init__(self, bot, guild, raw, handler)
 
+class Config:
+	def __init__(self, bot, guild, config, handler):
+		self.spam = SpamConfig(bot, guild, config, handler)
+		self.ping_spam = PingSpamConfig(bot, guild, config, handler)
+		self.curse = CurseConfig(bot, guild, config, handler)
+		self.invite = InviteConfig(bot, guild, config, handler)
+
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
 		handler = await InfractionHandler.new(bot, guild)
-		return cls(bot, guild, config, handler)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config, handler))
 
 class AutoRoleConfig:
 	def __init__(self, bot, guild, config):
@@ -111,25 +111,75 @@ class AutoRoleConfig:
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 class Plugin(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
 
-	@commands.Cog.listener("on_message")
-	async def anti_spam(self, message):
-		if message.guild is None:
-			return
+		# each detector is run in this order until one of them takes action on the message
+		self.detectors = (
+			("spam", self.anti_spam),
+			("ping_spam", self.anti_ping_spam),
+			("curse", self.anti_curse),
+			("invite", self.anti_invite)
+		)
+		self.timings = {}
+		self.invites = {}
+		self._invites_used = {}
+		self._fetching_invites = {}
+		self._invite_events = {}
+		self.limiter = rate_limit.new(bot)
+
+		self.invite_refresher.start()
+
+	def cog_unload(self):
+		self.invite_refresher.cancel()
+
+	def record(self, stage, started):
+		"""Adds the time taken by a stage of the message pipeline to its running total."""
 
-		config = await SpamConfig.new(self.bot, message.guild)
+		timing = self.timings.setdefault(stage, [0, 0.0])
+		timing[0] += 1
+		timing[1] += perf_counter() - started
 
-		if message.author in (self.bot.user, message.guild.owner) or not config.enabled or config.is_ignored(message.author, message.channel):
+	@commands.Cog.listener()
+	async def on_message(self, message):
+		# these checks don't need the config so they're done before we go looking for it
+		if message.guild is None or message.author == self.bot.user:
+			return
+
+		if message.author != message.guild.owner and await self.moderate(message):
 			return
 
-		count = self.bot.redis.incr(f"spam:{message.guild.id}:{message.author.id}")
-		self.bot.redis.expire(f"spam:{message.guild.id}:{message.author.id}", config.threshold)
+		# anything that reacts to regular messages (e.g. custom commands) listens for this
+		# so that it never responds to a message that auto-mod has just dealt with
+		self.bot.dispatch("clean_message", message)
+
+	async def moderate(self, message):
+		"""Runs the message through each enabled detector, returning True as soon as one of them takes action."""
+
+		started = perf_counter()
+		config = await Config.new(self.bot, message.guild)
+		self.record("config", started)
+
+		for name, detector in self.detectors:
+			stage = getattr(config, name)
+
+			if not stage.enabled or stage.is_ignored(message.author, message.channel):
+				continue
+
+			started = perf_counter()
+			actioned = await detector(message, stage)
+			self.record(name, started)
+
+			if actioned:
+				return True
+
+		return False
+
+	async def anti_spam(self, message, config):
+		count = await self.limiter.hit(f"spam:{message.guild.id}:{message.author.id}", config.count, config.threshold)
 
 		if count > config.count - 1:
 			if message.guild.me.guild_permissions.manage_messages:
@@ -139,80 +189,168 @@ class Plugin(commands.Cog):
 				)
 
 			await config.respond(message.author, f"Spam detected in #{message.channel} ({config.count}/{config.threshold}s)")
+			return True
 
-	@commands.Cog.listener("on_message")
-	async def anti_ping_spam(self, message):
-		if message.guild is None:
-			return
-
-		config = await PingSpamConfig.new(self.bot, message.guild)
+		return False
 
-		if message.author in (self.bot.user, message.guild.owner) or not message.mentions or not config.enabled or config.is_ignored(message.author, message.channel):
-			return
+	async def anti_ping_spam(self, message, config):
+		if not message.mentions:
+			return False
 
-		count = self.bot.redis.incr(f"ping:{message.guild.id}:{message.author.id}")
-		self.bot.redis.expire(f"ping:{message.guild.id}:{message.author.id}", config.threshold)
+		count = await self.limiter.hit(f"ping:{message.guild.id}:{message.author.id}", config.count, config.threshold)
 
 		if count > config.count - 1:
 			if message.guild.me.guild_permissions.manage_messages:
 				await message.delete()
 
 			await config.respond(message.author, f"Ping spam detected in #{message.channel} ({config.count}/{config.threshold}s)")
+			return True
 
-	@commands.Cog.listener("on_message")
-	async def anti_curse(self, message):
-		if message.guild is None:
-			return
+		return False
 
-		config = await CurseConfig.new(self.bot, message.guild)
+	async def anti_curse(self, message, config):
+		if config.blacklist.search(message.content) is None:
+			return False
 
-		if message.author in (self.bot.user, message.guild.owner) or not config.enabled or config.is_ignored(message.author, message.channel):
-			return
+		if message.guild.me.guild_permissions.manage_messages:
+			await message.delete()
 
-		for word in config.blacklist:
-			if word in message.content:
-				if message.guild.me.guild_permissions.manage_messages:
-					await message.delete()
+		await config.respond(message.author, f"Censored word detected in #{message.channel}")
+		return True
 
-				await config.respond(message.author, f"Censored word detected in #{message.channel}")
+	async def anti_invite(self, message, config):
+		codes = INVITE_REGEX.findall(message.content)
+		if not codes:
+			return False
 
-	@commands.Cog.listener("on_message")
-	async def anti_invite(self, message):
-		if message.guild is None:
-			return
+		own_invites = None
 
-		config = await InviteConfig.new(self.bot, message.guild)
+		for code in codes:
+			code = code.lower()
 
-		if message.author in (self.bot.user, message.guild.owner) or not config.enabled or config.is_ignored(message.author, message.channel):
-			return
+			if code in config.whitelist:
+				continue
+
+			# only look up the server's own invites once we know there's a link that isn't whitelisted
+			if own_invites is None:
+				own_invites = await self.guild_invites(message.guild)
+
+			if code in own_invites:
+				continue
+
+			if message.guild.me.guild_permissions.manage_messages:
+				await message.delete()
+
+			await config.respond(message.author, f"Invite detected in #{message.channel}")
+			return True
+
+		return False
+
+	async def guild_invites(self, guild):
+		"""Returns the set of invite codes that belong to the guild.
+
+		They're fetched the first time they're needed and then kept up to date by the invite events."""
+
+		self._invites_used[guild.id] = monotonic()
+
+		codes = self.invites.get(guild.id)
+		if codes is not None:
+			return codes
+
+		if not guild.me.guild_permissions.manage_guild:
+			return set()
+
+		return await shield(self.fetch_invites(guild))
+
+	def fetch_invites(self, guild):
+		"""Returns the task fetching a guild's invites, starting one if there isn't one running already.
+
+		During a raid lots of invite links arrive before the first fetch returns, so they all wait on the same request."""
+
+		fetch = self._fetching_invites.get(guild.id)
+
+		if fetch is None:
+			# invites created or deleted whilst the request is in flight might not be in its result
+			self._invite_events[guild.id] = []
+			fetch = self._fetching_invites[guild.id] = self.bot.loop.create_task(self._fetch_invites(guild))
+
+		return fetch
 
-		REGEX = r"(https?:\/\/)?(www\.)?(discord\.gg|discord\.com\/invite)\/.+[a-z]"
-		whitelisted_partial = "|".join(whitelist for whitelist in config.whitelist)
-		match = [m.group() for m in re.finditer(REGEX, message.content, re.IGNORECASE)]
+	async def _fetch_invites(self, guild):
+		try:
+			codes = {invite.code.lower() for invite in await guild.invites()}
 
-		if not match:
+			for created, code in self._invite_events.get(guild.id, ()):
+				if created:
+					codes.add(code)
+
+				else:
+					codes.discard(code)
+
+			self.invites[guild.id] = codes
+			return codes
+
+		finally:
+			if self._fetching_invites.get(guild.id) is current_task():
+				del self._fetching_invites[guild.id]
+				self._invite_events.pop(guild.id, None)
+
+	def invite_event(self, invite, created):
+		"""Keeps a guild's cached invites up to date, including any fetch of them that's still in flight."""
+
+		if invite.guild is None:
 			return
 
-		if message.guild.me.guild_permissions.manage_guild:
-			invites = "|".join(invite.code for invite in await message.guild.invites())
+		code = invite.code.lower()
+		codes = self.invites.get(invite.guild.id)
 
-		for invite in match[0].split(" "):
-			if not re.search(REGEX, invite, re.IGNORECASE):
-				continue
+		if codes is not None:
+			if created:
+				codes.add(code)
 
-			if whitelisted_partial:
-				if re.search(rf"(https?:\/\/)?(www\.)?(discord\.gg|discord\.com\/invite)\/({whitelisted_partial})", invite, re.IGNORECASE):
-					continue
+			else:
+				codes.discard(code)
 
-			if message.guild.me.guild_permissions.manage_guild:
-				if re.search(rf"(https?:\/\/)?(www\.)?(discord\.gg|discord\.com\/invite)\/({invites})", invite, re.IGNORECASE) and invites:
-					continue
+		if invite.guild.id in self._invite_events:
+			self._invite_events[invite.guild.id].append((created, code))
 
-			if message.guild.me.guild_permissions.manage_messages:
-				await message.delete()
+	@commands.Cog.listener()
+	async def on_invite_create(self, invite):
+		self.invite_event(invite, True)
 
-			await config.respond(message.author, f"Invite detected in #{message.channel}")
-			break
+	@commands.Cog.listener()
+	async def on_invite_delete(self, invite):
+		self.invite_event(invite, False)
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild):
+		self.invites.pop(guild.id, None)
+		self._invites_used.pop(guild.id, None)
+
+	@tasks.loop(seconds=INVITE_REFRESH)
+	async def invite_refresher(self):
+		"""Re-fetches every cached invite set in case an invite event was missed.
+
+		The old set is kept until the new one arrives, so the cache never goes cold for guilds that are using it.
+		Guilds that haven't looked at their invites since the last refresh are dropped instead, so only active guilds stay cached."""
+
+		cutoff = monotonic() - INVITE_REFRESH
+
+		for guild_id in list(self.invites):
+			guild = self.bot.get_guild(guild_id)
+
+			if guild is None or not guild.me.guild_permissions.manage_guild or self._invites_used.get(guild_id, 0) < cutoff:
+				self.invites.pop(guild_id, None)
+				self._invites_used.pop(guild_id, None)
+				continue
+
+			try:
+				await self.fetch_invites(guild)
+
+			except Exception:
+				self.bot.log.warning(f"Failed to refresh the invites for {guild} ({guild.id}).", exc_info=True)
+
+		self.bot.log.debug(f"Refreshed the invites of {len(self.invites)} guilds.")
 
 	@commands.Cog.listener()
 	async def on_member_join(self, member):
@@ -248,4 +386,5 @@ class Plugin(commands.Cog):
 
 
 def setup(bot):
-	bot.add_cog(Plugin(bot))
\ No newline at end of file
+	ext.state.auto_mod = cog = Plugin(bot)
+	bot.add_cog(cog)
\ No newline at end of file
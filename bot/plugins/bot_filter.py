@@ -16,8 +16,7 @@ class Config:
 	
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(guild, config))
 
 
 class Plugin(commands.Cog):
@@ -30,7 +29,7 @@ class Plugin(commands.Cog):
 			return
 
 		config = await Config.new(self.bot, member.guild)
-		handler = InfractionHandler(self.bot, member.guild)
+		handler = await InfractionHandler.new(self.bot, member.guild)
 		
 		if not config.enabled or member.id in config.whitelist:
 			return
@@ -5,6 +5,10 @@ import core.prefix as prefix
 from discord.ext import commands
 
 
+# auto-mod dispatches clean_message for the messages it lets through, custom commands only fall back to on_message without it
+AUTO_MOD = "plugins.auto_mod"
+
+
 class ActionEnum:
 	SEND_MESSAGE = 0
 	TOGGLE_ROLE  = 1
@@ -18,24 +22,13 @@ class Command:
 		self.action = options.pop("action")
 		self.value = options.pop("value")
 
-	def triggers(self):
-		result = []
-		for p in prefix.all(self.bot):
-			# we have to ommit mentions here as it doesn't seem to work,
-			# might investigate and try to fix one day
-			if p != self.bot.user.mention:
-				result.append(f"{p}{self.name}")
-
-		return result
-
 class Config:
 	def __init__(self, bot, guild, config):
 		self.commands = [Command(bot, **c) for c in config.get("custom_commands", [])]
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 
 class Plugin(commands.Cog):
@@ -44,13 +37,32 @@ class Plugin(commands.Cog):
 
 	@commands.Cog.listener()
 	async def on_message(self, message):
+		"""Without auto-mod loaded there's nothing to dispatch clean_message, so every guild message is treated as clean."""
+
+		if message.guild is None or message.author == self.bot.user or AUTO_MOD in self.bot.extensions:
+			return
+
+		await self.on_clean_message(message)
+
+	@commands.Cog.listener()
+	async def on_clean_message(self, message):
+		"""Dispatched by auto-mod for guild messages that it hasn't taken action on."""
+
 		config = await Config.new(self.bot, message.guild)
 
 		if not config.commands:
 			return
 
+		matcher = await prefix.for_guild(self.bot, message.guild)
+
+		used_prefix = matcher.match(message.content)
+		if used_prefix is None:
+			return
+
+		invoked = message.content[len(used_prefix):]
+
 		for command in config.commands:
-			if message.content.startswith(tuple(command.triggers())):
+			if invoked.startswith(command.name):
 				if command.action == ActionEnum.SEND_MESSAGE:
 					return await message.channel.send(command.value.format(ctx=message))
 
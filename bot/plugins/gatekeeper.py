@@ -1,5 +1,6 @@
 import discord, os
 
+from asyncio import TimeoutError
 from claptcha import Claptcha
 from datetime import datetime
 from discord.ext import commands
@@ -69,8 +70,7 @@ class Config:
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 	async def verify(self, member):
 		if self.action == ActionEnum.ADD_ROLE:
@@ -97,6 +97,14 @@ class Config:
 
 		self._captcha_locks.add(ctx.author.id)
 
+		# the config is cached between events, so the lock has to be released however the check ends
+		try:
+			await self.run_captcha(ctx)
+
+		finally:
+			self._captcha_locks.discard(ctx.author.id)
+
+	async def run_captcha(self, ctx):
 		looking_for, path = self.gen_captcha()
 		attempts = self.extras.get("attempts", 3)
 
@@ -117,26 +125,29 @@ class Config:
 			)
 
 		except discord.Forbidden:
-			self._captcha_locks.remove(ctx.author.id)
 			return await ctx.failure("I tried to DM you but it failed. Please check your DM settings and try again!")
 
-		os.remove(path)
+		finally:
+			os.remove(path)
 
 		for i in range(attempts):
-			msg = await self.bot.wait_for("message",
-				check=lambda m: isinstance(m.channel, discord.DMChannel) and m.author == ctx.author
-			)
+			try:
+				msg = await self.bot.wait_for("message",
+					timeout=self.extras.get("timeout", 300),
+					check=lambda m: isinstance(m.channel, discord.DMChannel) and m.author == ctx.author
+				)
+
+			except TimeoutError:
+				return await ctx.author.send(f"{self.bot.emojis.get('cross', '❌')} | You took too long to answer! To try again, run `{fmt_prefix('verify me')}` in {ctx.channel.mention}.")
 
 			if msg.content == looking_for:
 				await self.verify(ctx.author)
-				self._captcha_locks.remove(ctx.author.id)
 				return await ctx.author.send(f"{self.bot.emojis.get('tick', '✅')} | Correct! You've been given access to {ctx.guild}.")
 
 			elif i + 1 != attempts:
 				await ctx.author.send(f"{self.bot.emojis.get('cross', '❌')} | That's incorrect, you have {attempts - (i + 1)} attempts left.")
 
 		await ctx.author.send(f"{self.bot.emojis.get('cross', '❌')} | That's incorrect! To try again, run `{fmt_prefix('verify me')}` in {ctx.channel.mention}.")
-		self._captcha_locks.remove(ctx.author.id)
 
 	def run_checks(self, member):
 		avatar_check = False
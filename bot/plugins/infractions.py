@@ -1,11 +1,13 @@
-import discord
+import discord, menus
 
 import ext.state as state
 
 from ast import literal_eval
+from asyncio import Semaphore, TimeoutError, gather
 from datetime import datetime, timedelta
 from discord.ext import commands
 from tabulate import tabulate
+from time import monotonic
 from typing import Union
 
 from ext.converters import BanCandidateConverter, DurationConverter
@@ -15,6 +17,16 @@ from ext.utils import dedent, clean_user, time_since
 
 from plugins.logging import Handler as LoggingHandler
 
+TYPE_IDS = {
+	"ban": 0,
+	"kick": 1,
+	"mute": 2,
+	"warn": 3
+}
+
+# how many actions a mass ban, kick or mute sends to Discord at once, discord.py waits out the rate limit of each route on top of this
+MASS_CONCURRENCY = 5
+
 class AlreadyMuted(CustomException):
 	pass
 
@@ -25,6 +37,106 @@ class CannotPunish(CustomException):
 	def __init__(self, reason):
 		self.reason = reason
 
+class InfractionSource(menus.PageSource):
+	"""Pages through the infractions matching a condition, newest first.
+
+	Pages are fetched as they're viewed, each one starting after the lowest ID of the one before it,
+	so no page ever needs more than per_page + 1 rows regardless of how many infractions a guild has.
+	The total is only counted up to count_cap, anything above that is shown as count_cap+."""
+
+	TS_FORMAT = "%d/%m/%y %H:%M:%S"
+	TYPE_NAMES = {
+		0: "ban",
+		1: "kick",
+		2: "mute",
+		3: "warn"
+	}
+
+	def __init__(self, bot, guild, condition, *args, per_page=10, count_cap=1000):
+		self.bot = bot
+		self.guild = guild
+		self.condition = condition
+		self.args = args
+
+		self.per_page = per_page
+		self.count_cap = count_cap
+		self.total = None
+
+		# the page at index n starts below _cursors[n], a page is only reachable once the one before it has been fetched
+		self._cursors = [None]
+		self._pages = {}
+
+	async def prepare(self):
+		async with self.bot.postgres.acquire() as con:
+			query = f"""SELECT count(*) FROM (
+						   SELECT 1 FROM infractions WHERE {self.condition} LIMIT {self.count_cap + 1}
+					   ) AS capped;"""
+
+			self.total = await con.fetchval(query, *self.args)
+
+	def is_paginating(self):
+		return len(self._cursors) > 1
+
+	async def get_page(self, page_number):
+		if page_number in self._pages:
+			return self._pages[page_number]
+
+		if not 0 <= page_number < len(self._cursors):
+			raise IndexError(page_number)
+
+		cursor = self._cursors[page_number]
+		args = [*self.args]
+
+		query = f"""SELECT id, target_id, actor_id, type_id, reason, created_at FROM infractions WHERE {self.condition}"""
+		if cursor is not None:
+			args.append(cursor)
+			query += f""" AND id < ${len(args)}"""
+
+		async with self.bot.postgres.acquire() as con:
+			rows = await con.fetch(query + f""" ORDER BY id DESC LIMIT {self.per_page + 1};""", *args)
+
+		if not rows and page_number:
+			raise IndexError(page_number)
+
+		# the extra row only tells us whether there's another page after this one
+		page = rows[:self.per_page]
+		if len(rows) > self.per_page and page_number == len(self._cursors) - 1:
+			self._cursors.append(page[-1]["id"])
+
+		self._pages[page_number] = page
+		return page
+
+	async def format_page(self, menu, page):
+		start = menu.current_page * self.per_page
+		total = f"{self.count_cap}+" if self.total > self.count_cap else self.total
+
+		return dedent(f"""🔎 Showing {start + 1}-{start + len(page)}/{total} found infractions:
+			```md
+			{tabulate(
+				tabular_data=[
+					[
+						infraction["id"],
+						clean_user(self.guild, infraction["target_id"]),
+						clean_user(self.guild, infraction["actor_id"]),
+						self.TYPE_NAMES.get(infraction["type_id"]),
+						infraction["reason"],
+						infraction["created_at"].strftime(self.TS_FORMAT)
+					] for infraction in page
+				],
+				headers=("ID", "Target", "Actor", "Type", "Reason", "Timestamp"),
+				tablefmt="simple",
+				numalign="left", 
+				stralign="left"
+			)}```""")
+
+
+class Paginator(menus.MenuPages):
+	def __init__(self, source):
+		super().__init__(
+			source=source, 
+			clear_reactions_after=True
+		)
+
 class Handler:
 	def __init__(self, bot, guild, config):
 		self.bot = bot
@@ -37,8 +149,7 @@ class Handler:
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 	async def insert(self, actor, target, event, reason):
 		if not isinstance(actor, int):
@@ -47,12 +158,7 @@ class Handler:
 		if not isinstance(target, int):
 			target = target.id
 
-		type_id = {
-			"ban": 0,
-			"kick": 1,
-			"mute": 2,
-			"warn": 3
-		}.get(event, 0)
+		type_id = TYPE_IDS.get(event, 0)
 
 		async with self.bot.postgres.acquire() as con:
 			query = """INSERT INTO infractions (guild_id, actor_id, target_id, type_id, reason, created_at) 
@@ -89,17 +195,19 @@ class Handler:
 			delete_message_days=self.ban_purge_days
 		)
 
-		case = await self.insert(actor, target, "ban", reason)
-		log = await LoggingHandler.new(self.bot, self.guild)
+		# the insert and the log config fetch don't depend on each other, only the steps after them need the case ID
+		case, log = await gather(self.insert(actor, target, "ban", reason), LoggingHandler.new(self.bot, self.guild))
 
 		if duration is not None:
-			await self.timer("ban", target, case, duration)
-			await log.dispatch("MEMBER_TEMPBAN", target,
-				target=target,
-				actor=actor,
-				duration=time_since(seconds=duration),
-				reason=reason,
-				case=case	
+			await gather(
+				self.timer("ban", target, case, duration),
+				log.dispatch("MEMBER_TEMPBAN", target,
+					target=target,
+					actor=actor,
+					duration=time_since(seconds=duration),
+					reason=reason,
+					case=case	
+				)
 			)
 
 		else:
@@ -112,6 +220,96 @@ class Handler:
 
 		return case
 
+	async def mass(self, actor, action, targets, reason, duration=None, progress=None):
+		"""Bans, kicks or mutes several users at once and returns the case IDs of the ones that succeeded.
+		
+		Targets are expected to have been checked beforehand, any that Discord refuses to action are skipped.
+		Every infraction is inserted with one query and a single MEMBER_MASS_* event is logged in place of one per user,
+		which also means that the targets aren't sent a DM.
+		If progress is provided, it's awaited with the number of targets done so far and the total after each one."""
+
+		permission = {"ban": "ban_members", "kick": "kick_members", "mute": "manage_roles"}[action]
+
+		if not getattr(self.guild.me.guild_permissions, permission):
+			raise commands.BotMissingPermissions([permission])
+
+		if action == "mute":
+			if self.mute_role is None:
+				raise NotConfigured("infractions.mute_role")
+
+			targets = [t for t in targets if self.mute_role not in t.roles]
+
+		semaphore = Semaphore(MASS_CONCURRENCY)
+		punished = []
+		done = 0
+
+		async def punish(target):
+			nonlocal done
+
+			async with semaphore:
+				try:
+					if action == "ban":
+						await self.guild.ban(target,
+							reason=f"{actor}: {reason}",
+							delete_message_days=self.ban_purge_days
+						)
+
+					elif action == "kick":
+						await self.guild.kick(target,
+							reason=f"{actor}: {reason}"
+						)
+
+					else:
+						await target.add_roles(self.mute_role,
+							reason=f"{actor}: {reason}"
+						)
+
+					punished.append(target)
+
+				except discord.HTTPException:
+					pass
+
+			done += 1
+			if progress is None:
+				return
+
+			# the infractions still have to be recorded if reporting progress fails, e.g. when the progress message is deleted
+			try:
+				await progress(done, len(targets))
+
+			except Exception:
+				self.bot.log.debug("Failed to report the progress of a mass action.", exc_info=True)
+
+		await gather(*(punish(target) for target in targets))
+
+		if not punished:
+			return []
+
+		async with self.bot.postgres.acquire() as con:
+			query = """INSERT INTO infractions (guild_id, actor_id, target_id, type_id, reason, created_at)
+					   SELECT $1, $2, target_id, $4, $5, $6 FROM unnest($3::BIGINT[]) AS target_id
+					   
+					   RETURNING id, target_id;"""
+
+			rows = await con.fetch(query, self.guild.id, actor.id, [t.id for t in punished], TYPE_IDS[action], reason, datetime.utcnow())
+
+		cases = {r["target_id"]: r["id"] for r in rows}
+
+		if duration is not None:
+			await gather(*(self.timer(action, target, cases[target.id], duration) for target in punished))
+
+		log = await LoggingHandler.new(self.bot, self.guild)
+		await log.dispatch(f"MEMBER_MASS_{action.upper()}",
+			actor=actor,
+			count=len(cases),
+			first_case=min(cases.values()),
+			last_case=max(cases.values()),
+			duration=f" for {time_since(seconds=duration)}" if duration is not None else "",
+			reason=reason
+		)
+
+		return sorted(cases.values())
+
 	async def unban(self, actor, target, case=None):
 		if not self.guild.me.guild_permissions.ban_members:
 			raise commands.BotMissingPermissions(["ban_members"])
@@ -146,8 +344,7 @@ class Handler:
 			reason=f"{actor}: {reason}"
 		)
 
-		case = await self.insert(actor, target, "ban", reason)
-		log = await LoggingHandler.new(self.bot, self.guild)
+		case, log = await gather(self.insert(actor, target, "ban", reason), LoggingHandler.new(self.bot, self.guild))
 		await log.dispatch("MEMBER_KICK", target,
 			target=target,
 			actor=actor,
@@ -174,17 +371,18 @@ class Handler:
 			reason=f"{actor}: {reason}"			
 		)
 
-		case = await self.insert(actor, target, "mute", reason)
-		log = await LoggingHandler.new(self.bot, self.guild)
+		case, log = await gather(self.insert(actor, target, "mute", reason), LoggingHandler.new(self.bot, self.guild))
 
 		if duration is not None:
-			await self.timer("mute", target, case, duration)
-			await log.dispatch("MEMBER_TEMPMUTE", target,
-				target=target,
-				actor=actor,
-				duration=time_since(seconds=duration),
-				reason=reason,
-				case=case	
+			await gather(
+				self.timer("mute", target, case, duration),
+				log.dispatch("MEMBER_TEMPMUTE", target,
+					target=target,
+					actor=actor,
+					duration=time_since(seconds=duration),
+					reason=reason,
+					case=case	
+				)
 			)
 
 		else:
@@ -230,8 +428,7 @@ class Handler:
 		if (target.top_role.position >= actor.top_role.position or self.guild.owner == target) and actor != self.guild.owner:
 			raise AccessDenied()
 
-		case = await self.insert(actor, target, "warn", reason)
-		log = await LoggingHandler.new(self.bot, self.guild)
+		case, log = await gather(self.insert(actor, target, "warn", reason), LoggingHandler.new(self.bot, self.guild))
 		await log.dispatch("MEMBER_WARN", target,
 			target=target,
 			actor=actor,
@@ -253,6 +450,11 @@ class Plugin(commands.Cog, name="User Infractions"):
 	def __init__(self, bot):
 		self.bot = bot
 
+		config = bot.config.get("mass_actions", {})
+
+		self.confirm_timeout = config.get("confirm_timeout", 30)
+		self.max_joins = config.get("max_joins", 50)
+
 	async def error_handler(self, ctx, error, res):
 		if isinstance(error, commands.CommandInvokeError):
 			if isinstance(error.original, AlreadyMuted):
@@ -285,6 +487,78 @@ class Plugin(commands.Cog, name="User Infractions"):
 		if target.top_role >= actor.guild.me.top_role:
 			raise CannotPunish(f"My highest role ({actor.guild.me.top_role.mention}) needs to be above {target}'s highest role ({target.top_role.mention})")
 
+	def can_punish(self, actor, target):
+		try:
+			self.check_perms(actor, target)
+
+		except CannotPunish:
+			return False
+
+		return True
+
+	async def confirm(self, ctx, content):
+		"""Asks the author to confirm an action by reacting to a message.
+		
+		Returns False if they cancel it or don't react within the confirmation timeout."""
+
+		tick, cross = self.bot.emojis.get("tick", "✅"), self.bot.emojis.get("cross", "❌")
+
+		message = await ctx.send(f"⚠️ | {ctx.author.mention}: {content} React with {tick} to confirm or {cross} to cancel.")
+		for emoji in (tick, cross):
+			await message.add_reaction(emoji)
+
+		try:
+			reaction, _ = await self.bot.wait_for("reaction_add",
+				timeout=self.confirm_timeout,
+				check=lambda r, u: u == ctx.author and r.message.id == message.id and str(r.emoji) in (tick, cross)
+			)
+
+		except TimeoutError:
+			return False
+
+		return str(reaction.emoji) == tick
+
+	async def mass_action(self, ctx, action, targets, reason, duration=None, confirm=False):
+		"""Runs a mass action against every target the author is allowed to punish, keeping a progress message up to date.
+		
+		If a duration is provided, the action is undone after that many seconds.
+		If confirm is True, the author is shown how many users will be punished and has to confirm it first.
+		Going past the configured max_joins then needs the Admin access level."""
+
+		targets = [t for t in dict.fromkeys(targets) if self.can_punish(ctx.author, t)]
+		if not targets:
+			raise LookupFailed("punishable users")
+
+		verb = {"ban": "banned", "kick": "kicked", "mute": "muted"}[action]
+
+		if confirm:
+			if len(targets) > self.max_joins and not await access_control.has_level(ctx, access_control.Level.ADMIN):
+				return await ctx.error(f"That would {action} {len(targets)} users, only admins can {action} more than {self.max_joins} at once.")
+
+			if not await self.confirm(ctx, f"This will {action} {len(targets)} users."):
+				return await ctx.error(f"Cancelled, nobody has been {verb}.")
+
+		message = await ctx.send(f"⏳ | {ctx.author.mention}: 0/{len(targets)} users have been {verb} so far.")
+		last_edit = monotonic()
+
+		async def progress(done, total):
+			nonlocal last_edit
+
+			# editing on every action would hit the channel's rate limit long before the actions do
+			if done < total and monotonic() - last_edit < 2:
+				return
+
+			last_edit = monotonic()
+			await message.edit(content=f"⏳ | {ctx.author.mention}: {done}/{total} users have been {verb} so far.")
+
+		handler = await Handler.new(self.bot, ctx.guild)
+		cases = await handler.mass(ctx.author, action, targets, reason, duration, progress)
+
+		if duration is not None:
+			verb += f" for {time_since(seconds=duration)}"
+
+		await ctx.success(f"{len(cases)}/{len(targets)} users have been {verb} for:\n{reason}")
+
 	@access_control.require(access_control.Level.TRUSTED)
 	@commands.command("bean",
 		usage="bean <target:user> [reason:text]",
@@ -456,6 +730,104 @@ class Plugin(commands.Cog, name="User Infractions"):
 		
 		await ctx.success(f"{target} (`{target.id}`) has been warned for:\n{reason}")
 
+	@access_control.require(access_control.Level.MOD)
+	@commands.group("mass",
+		usage="mass",
+		invoke_without_command=True
+	)
+	async def mass(self, ctx):
+		"""This allows you to punish lots of users at once, for example during a raid."""
+
+		raise MissingSubcommand()
+
+	@access_control.require(access_control.Level.MOD)
+	@mass.command("ban",
+		usage="mass ban <targets:user...> [reason:text]"
+	)
+	@commands.bot_has_permissions(ban_members=True)
+	async def mass_ban(self, ctx,
+		targets: commands.Greedy[BanCandidateConverter],
+		*, reason: str = "No reason given."
+	):
+		"""Banishes every provided user from the server. Providing IDs allows for hackbans instead."""
+
+		await self.mass_action(ctx, "ban", targets, reason)
+
+	@access_control.require(access_control.Level.MOD)
+	@mass.command("tempban",
+		usage="mass tempban <duration:text> <targets:user...> [reason:text]"
+	)
+	@commands.bot_has_permissions(ban_members=True)
+	async def mass_tempban(self, ctx,
+		duration: DurationConverter,
+		targets: commands.Greedy[BanCandidateConverter],
+		*, reason: str = "No reason given."
+	):
+		"""Bans every provided user for a certain amount of time then unbans them afterwards."""
+
+		await self.mass_action(ctx, "ban", targets, reason, duration)
+
+	@access_control.require(access_control.Level.MOD)
+	@mass.command("kick",
+		usage="mass kick <targets:user...> [reason:text]"
+	)
+	@commands.bot_has_permissions(kick_members=True)
+	async def mass_kick(self, ctx,
+		targets: commands.Greedy[discord.Member],
+		*, reason: str = "No reason given."
+	):
+		"""Kicks every provided user from the server."""
+
+		await self.mass_action(ctx, "kick", targets, reason)
+
+	@access_control.require(access_control.Level.MOD)
+	@mass.command("mute",
+		usage="mass mute <targets:user...> [reason:text]"
+	)
+	@commands.bot_has_permissions(manage_roles=True)
+	async def mass_mute(self, ctx,
+		targets: commands.Greedy[discord.Member],
+		*, reason: str = "No reason given."
+	):
+		"""Gives every provided user the configured mute role."""
+
+		await self.mass_action(ctx, "mute", targets, reason)
+
+	@access_control.require(access_control.Level.MOD)
+	@mass.command("tempmute",
+		usage="mass tempmute <duration:text> <targets:user...> [reason:text]"
+	)
+	@commands.bot_has_permissions(manage_roles=True)
+	async def mass_tempmute(self, ctx,
+		duration: DurationConverter,
+		targets: commands.Greedy[discord.Member],
+		*, reason: str = "No reason given."
+	):
+		"""Temporarily gives every provided user the configured mute role then removes it after."""
+
+		await self.mass_action(ctx, "mute", targets, reason, duration)
+
+	@access_control.require(access_control.Level.MOD)
+	@mass.command("joins",
+		usage="mass joins <action:ban|kick|mute> <within:text> [reason:text]"
+	)
+	async def mass_joins(self, ctx,
+		action: str,
+		within: DurationConverter,
+		*, reason: str = "No reason given."
+	):
+		"""Bans, kicks or mutes everyone who joined the server within the provided amount of time."""
+
+		action = action.lower()
+		if action not in ("ban", "kick", "mute"):
+			raise commands.BadArgument()
+
+		since = datetime.utcnow() - timedelta(seconds=within)
+		targets = [m for m in ctx.guild.members if m.joined_at is not None and m.joined_at >= since]
+
+		# a typo in the duration could catch most of the server, so the author has to check the count first
+		await self.mass_action(ctx, action, targets, reason, confirm=True)
+
 	@commands.group("inf",
 		usage="inf",
 		aliases=["infractions"],
@@ -500,51 +872,16 @@ class Plugin(commands.Cog, name="User Infractions"):
 	):
 		"""Fetches a specific infraction with the provided ID or lists a user's infractions."""
 
-		MAX = 10
-		TS_FORMAT = "%d/%m/%y %H:%M:%S"
-
-		async with self.bot.postgres.acquire() as con:
-			if isinstance(target, (discord.Member, discord.User)):
-				search_id = target.id
-				query = """SELECT id, target_id, actor_id, type_id, reason, created_at FROM infractions
-						   WHERE (target_id = $1 OR actor_id = $1) AND guild_id = $2
-						   ORDER BY id DESC;"""
-
-			else:
-				search_id = target
-				query = """SELECT id, target_id, actor_id, type_id, reason, created_at FROM infractions
-						   WHERE id = $1 AND guild_id = $2;"""
-
-			cases = await con.fetch(query, search_id, ctx.guild.id)
+		if isinstance(target, (discord.Member, discord.User)):
+			source = InfractionSource(self.bot, ctx.guild, "(target_id = $1 OR actor_id = $1) AND guild_id = $2", target.id, ctx.guild.id)
 
-			if not cases:
-				raise LookupFailed("infractions")
+		else:
+			source = InfractionSource(self.bot, ctx.guild, "id = $1 AND guild_id = $2", target, ctx.guild.id)
 
-			type_str = {
-				0: "ban",
-				1: "kick",
-				2: "mute",
-				3: "warn"
-			}
+		if not await source.get_page(0):
+			raise LookupFailed("infractions")
 
-			await ctx.send(dedent(f"""🔎 Showing {len(cases[:MAX])}/{len(cases)} found infractions:
-				```md
-				{tabulate(
-					tabular_data=[
-						[
-							infraction["id"],
-							clean_user(ctx.guild, infraction["target_id"]),
-							clean_user(ctx.guild, infraction["actor_id"]),
-							type_str.get(infraction["type_id"]),
-							infraction["reason"],
-							infraction["created_at"].strftime(TS_FORMAT)
-						] for infraction in cases[:MAX]
-					],
-					headers=("ID", "Target", "Actor", "Type", "Reason", "Timestamp"),
-					tablefmt="simple",
-					numalign="left", 
-					stralign="left"
-				)}```"""))
+		await Paginator(source).start(ctx)
 
 	@access_control.require(access_control.Level.MOD)
 	@inf.command("recent",
@@ -553,43 +890,12 @@ class Plugin(commands.Cog, name="User Infractions"):
 	async def inf_recent(self, ctx):
 		"""Shows the most recent infractions for the server."""
 
-		MAX = 10
-		TS_FORMAT = "%d/%m/%y %H:%M:%S"
-
-		async with self.bot.postgres.acquire() as con:
-			query = """SELECT id, target_id, actor_id, type_id, reason, created_at FROM infractions
-					   WHERE guild_id = $1
-					   ORDER BY created_at DESC;"""
+		source = InfractionSource(self.bot, ctx.guild, "guild_id = $1", ctx.guild.id)
 
-			cases = await con.fetch(query, ctx.guild.id)
-			if not cases:
-				raise LookupFailed("infractions")
-
-			type_str = {
-				0: "ban",
-				1: "kick",
-				2: "mute",
-				3: "warn"
-			}
+		if not await source.get_page(0):
+			raise LookupFailed("infractions")
 
-			await ctx.send(dedent(f"""🔎 Showing {len(cases[:MAX])}/{len(cases)} found infractions:
-				```md
-				{tabulate(
-					tabular_data=[
-						[
-							infraction["id"],
-							clean_user(ctx.guild, infraction["target_id"]),
-							clean_user(ctx.guild, infraction["actor_id"]),
-							type_str.get(infraction["type_id"]),
-							infraction["reason"],
-							infraction["created_at"].strftime(TS_FORMAT)
-						] for infraction in cases[:MAX]
-					],
-					headers=("ID", "Target", "Actor", "Type", "Reason", "Timestamp"),
-					tablefmt="simple",
-					numalign="left", 
-					stralign="left"
-				)}```"""))
+		await Paginator(source).start(ctx)
 
 	@commands.Cog.listener()
 	async def on_temp_mute_expire(self, target_id, guild_id, case_id):
@@ -642,7 +948,7 @@ class Plugin(commands.Cog, name="User Infractions"):
 
 	@commands.Cog.listener()
 	async def on_member_unban(self, guild, user):
-		expiring_timer = state.timer_handler.get("temp_ban", {
+		expiring_timer = await state.timer_handler.get("temp_ban", {
 				"target_id": user.id,
 				"guild_id": guild.id
 			}
@@ -659,9 +965,9 @@ class Plugin(commands.Cog, name="User Infractions"):
 			return
 
 		if config.mute_role not in after.roles and config.mute_role in before.roles:
-			expiring_timer = state.timer_handler.get("temp_mute", {
-					"target": after.id,
-					"guild": after.guild.id
+			expiring_timer = await state.timer_handler.get("temp_mute", {
+					"target_id": after.id,
+					"guild_id": after.guild.id
 				}
 			)
 
@@ -41,8 +41,7 @@ class Config:
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 	async def start(self, actor, channel, duration=None):
 		if not channel.permissions_for(channel.guild.me).manage_channels:
@@ -130,7 +129,7 @@ class Config:
 			overwrites=overwrites
 		)
 
-		expiring_timer = state.timer_handler.get("lockdown", {"channel": channel.id})
+		expiring_timer = await state.timer_handler.get("lockdown", {"channel_id": channel.id})
 
 		if expiring_timer is not None:
 			await expiring_timer.cancel()
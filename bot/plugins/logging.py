@@ -1,8 +1,69 @@
 import discord
 
-from datetime import datetime
+import ext.state
+
+from aiohttp import ClientSession
+from asyncio import Event, TimeoutError, gather, sleep, wait_for
+from collections import deque
+from datetime import datetime, timedelta
 from discord.ext import commands
-from ext.utils import ordinal_indicator, time_since
+from ext.utils import ordinal_indicator, shards, time_since
+from json import dumps, loads
+from string import Formatter
+
+
+def escape(text):
+	return text.replace("{", "{{").replace("}", "}}")
+
+def compose(base, **parts):
+	"""Fills some of the fields in a format string with other format strings, leaving the rest of its fields in place.
+	
+	This lets the base format and an action's text be rendered with a single str.format call."""
+
+	template = ""
+
+	for literal, field, spec, conversion in Formatter().parse(base):
+		template += escape(literal)
+
+		if field is None:
+			continue
+
+		if field in parts:
+			template += parts[field]
+
+		else:
+			template += "{" + field + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}"
+
+	return template
+
+class Templates:
+	"""The log and DM format strings of every action, with the base format and emoji already filled in.
+	
+	These are built once from bot.actions so rendering an event is a single lookup and format."""
+
+	def __init__(self, actions):
+		self.time_format = actions.get("time_format")
+		self.dm_fail = actions.get("dm_fail_base")
+
+		self.log = {}
+		self.dm = {}
+		self.infractions = {}
+
+		for event, action in actions.items():
+			if not isinstance(action, dict):
+				continue
+
+			emoji = escape(str(action.get("emoji")))
+			self.infractions[event] = action.get("infraction", "???")
+
+			if action.get("text") is not None:
+				self.log[event] = compose(actions.get("base"), emoji=emoji, text=action["text"])
+
+			if action.get("dm") is not None:
+				self.dm[event] = compose(actions.get("base"), emoji=emoji, text=action["dm"])
+
+	def timestamp(self):
+		return datetime.utcnow().strftime(self.time_format)
 
 
 class Handler:
@@ -10,72 +71,502 @@ class Handler:
 		self.bot = bot
 		self.guild = guild
 
-		self.logs = {self.guild.get_channel(cid): e for cid, e in config.get("logs", {}).items()}
+		# an index of which channels each event is logged in, built once per config rather than searched on every event
+		self.channels = {}
+
+		for cid, events in config.get("logs", {}).items():
+			channel = self.guild.get_channel(cid)
+
+			if channel is None:
+				continue
+
+			for event in events:
+				self.channels.setdefault(event, []).append(channel)
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 	def dm_fail_format(self, event, target):
-		base = self.bot.actions.get("dm_fail_base")
-		infr_name = self.bot.actions.get(event, {}).get("infraction", "???")
+		templates = self.bot.action_templates
 
-		return base.format(
-			at=datetime.utcnow().strftime(self.bot.actions.get("time_format")),
+		return templates.dm_fail.format(
+			at=templates.timestamp(),
 			target=target,
-			infraction=infr_name
+			infraction=templates.infractions.get(event, "???")
 		)
 
 	def dm_format(self, event, **options):
-		base = self.bot.actions.get("base")
-		dm_base = self.bot.actions.get(event, {}).get("dm")
-
-		return base.format(
-			at=datetime.utcnow().strftime(self.bot.actions.get("time_format")),
-			emoji=self.bot.actions.get(event, {}).get("emoji"),
-			text=dm_base.format(
-				guild=self.guild,
-				**options
-			)
+		templates = self.bot.action_templates
+
+		return templates.dm[event].format(
+			at=templates.timestamp(),
+			guild=self.guild,
+			**options
 		)
 
 	def log_format(self, event, **options):
-		base = self.bot.actions.get("base")
-		log_base = self.bot.actions.get(event, {}).get("text")
+		templates = self.bot.action_templates
 
-		return base.format(
-			at=datetime.utcnow().strftime(self.bot.actions.get("time_format")),
-			emoji=self.bot.actions.get(event, {}).get("emoji"),
-			text=log_base.format(**options)
+		return templates.log[event].format(
+			at=templates.timestamp(),
+			**options
 		)
 
 	async def dispatch(self, event, user_to_dm=None, **options):
-		logs = [c for c, e in self.logs.items() if event in e]
-		failed_to_dm = False
+		"""Queues an event for every log channel listening for it, then DMs the user about it.
+		
+		If the DM fails, the channels are told about it after the event."""
+
+		dispatcher = ext.state.log_dispatcher
+		logs = self.channels.get(event, ())
+
+		for log in logs:
+			dispatcher.send(log, self.log_format(event, **options))
+
+		if user_to_dm is None:
+			return
+
+		fallback = [(log, self.dm_fail_format(event, user_to_dm)) for log in logs]
+
+		if user_to_dm.bot:
+			for log, line in fallback:
+				dispatcher.send(log, line)
+
+			return
+
+		await dispatcher.send_dm(user_to_dm, self.dm_format(event, **options), fallback, self.guild)
+
+class Dispatcher:
+	"""Queues log lines per channel and sends them in batches instead of one message per event.
+	
+	Lines that arrive within window seconds of each other are joined into as few messages as fit under the 2000 character limit,
+	and anything queued while a batch is being sent goes out with the next one, so a busy channel never has more than one send waiting.
+	Each channel holds at most max_queue lines, any more are dropped and counted, then reported in the channel with the next batch.
+
+	If webhooks is True, batches are sent through a webhook in each channel so that they don't share rate limits with the bot's
+	own messages. The webhooks are created as needed and all of them send through a single HTTP session.
+	Channels where a webhook can't be used fall back to sending as the bot."""
+
+	MAX_LENGTH = 2000
+	WEBHOOK_NAME = "Captain Logs"
+
+	def __init__(self, bot, window=1.0, max_queue=500, webhooks=False):
+		self.bot = bot
+		self.window = window
+		self.max_queue = max_queue
+		self.webhooks = webhooks
+
+		self._queues = {}
+		self._flushers = {}
+		self._dropped = {}
+
+		self._session = None
+		self._webhooks = {}
+
+		self.sent = 0
+		self.overflowed = 0
+
+	def send(self, channel, line):
+		queue = self._queues.setdefault(channel.id, deque())
+
+		if len(queue) >= self.max_queue:
+			self._dropped[channel.id] = self._dropped.get(channel.id, 0) + 1
+			self.overflowed += 1
+
+			return
+
+		queue.append(line)
+
+		if channel.id not in self._flushers:
+			self._flushers[channel.id] = self.bot.loop.create_task(self.flush(channel))
+
+	async def send_dm(self, user, content, fallback, guild=None):
+		"""DMs a user, queueing the fallback (channel, line) pairs instead if the DM fails."""
+
+		try:
+			await user.send(content)
+
+		except:
+			for channel, line in fallback:
+				self.send(channel, line)
+
+	def batch(self, lines):
+		"""Groups lines into lists that each fit in a message once joined by newlines.
+		
+		Any single line that's too long by itself is cut short."""
+
+		chunk, length = [], 0
+
+		for line in lines:
+			if len(line) > self.MAX_LENGTH:
+				line = line[:self.MAX_LENGTH - 1] + "…"
+
+			if chunk and length + len(line) + 1 > self.MAX_LENGTH:
+				yield chunk
+				chunk, length = [], 0
+
+			length += len(line) + bool(chunk)
+			chunk.append(line)
+
+		if chunk:
+			yield chunk
+
+	async def stats(self):
+		return {
+			"Messages sent": self.sent,
+			"Lines waiting": sum(len(queue) for queue in self._queues.values()),
+			"Lines dropped": self.overflowed
+		}
+
+	async def flush(self, channel):
+		"""Sends whatever is queued for a channel every window seconds until its queue stays empty."""
+
+		try:
+			while True:
+				await sleep(self.window)
+
+				queue = self._queues.get(channel.id)
+				if not queue:
+					break
+
+				lines = [queue.popleft() for _ in range(len(queue))]
+
+				dropped = self._dropped.pop(channel.id, 0)
+				if dropped:
+					lines.append(f"⚠️ {dropped} log messages were dropped because too many arrived at once.")
+
+				for chunk in self.batch(lines):
+					try:
+						await self.deliver(channel, "\n".join(chunk))
+						self.sent += 1
+
+					except discord.HTTPException:
+						self.bot.log.warning(f"Failed to send a batch of logs to {channel} ({channel.id}).", exc_info=True)
+
+		finally:
+			del self._flushers[channel.id]
+			self._queues.pop(channel.id, None)
+
+	async def webhook(self, channel):
+		"""Returns the logging webhook for a channel, creating it if it doesn't exist yet.
+		
+		Returns None if the bot isn't allowed to manage the channel's webhooks."""
+
+		if channel.id in self._webhooks:
+			return self._webhooks[channel.id]
+
+		if not channel.permissions_for(channel.guild.me).manage_webhooks:
+			return None
+
+		if self._session is None:
+			self._session = ClientSession()
+
+		existing = [w for w in await channel.webhooks() if w.name == self.WEBHOOK_NAME and w.user == self.bot.user]
+		hook = existing[0] if existing else await channel.create_webhook(name=self.WEBHOOK_NAME)
+
+		self._webhooks[channel.id] = webhook = discord.Webhook.from_url(hook.url,
+			adapter=discord.AsyncWebhookAdapter(self._session)
+		)
+
+		return webhook
+
+	async def deliver(self, channel, message):
+		if not self.webhooks:
+			return await channel.send(message)
 
-		if user_to_dm is not None:
-			if user_to_dm.bot:
-				failed_to_dm = True
+		try:
+			webhook = await self.webhook(channel)
+
+		except discord.HTTPException:
+			webhook = None
+
+		if webhook is None:
+			return await channel.send(message)
+
+		try:
+			await webhook.send(message,
+				username=self.bot.user.name,
+				avatar_url=str(self.bot.user.avatar_url)
+			)
+
+		except discord.NotFound:
+			# someone deleted the webhook, it'll be recreated for the next batch
+			self._webhooks.pop(channel.id, None)
+			await channel.send(message)
+
+	async def close(self):
+		if self._session is not None:
+			await self._session.close()
+
+class OutboxDispatcher(Dispatcher):
+	"""A Dispatcher that stores log lines and DMs in the outbox table before they're sent, so they survive restarts and outages.
+	
+	Lines are written to the table in batches by a background task, so callers never wait on Discord or Postgres.
+	A delivery worker claims due rows, sends them batched per channel or user, deletes the ones that went through
+	and retries the rest with exponential backoff, giving up after MAX_ATTEMPTS.
+	Claimed rows are leased for LEASE seconds, so deliveries that a crashed process was in the middle of are retried by the next one.
+	At most max_queue rows wait in memory to be written, any more are dropped and counted."""
+
+	LEASE = 60
+	POLL_INTERVAL = 5
+	CLAIM_SIZE = 500
+	MAX_ATTEMPTS = 10
+	MAX_BACKOFF = 600
+
+	def __init__(self, bot, **kwargs):
+		super().__init__(bot, **kwargs)
+
+		self._pending = []
+		self._writer = None
+		self._wakeup = Event()
+		self.worker = None
+
+		self.delivered = 0
+		self.abandoned = 0
+		self.latency = 0.0
+
+	def start(self):
+		if self.worker is None:
+			self.worker = self.bot.loop.create_task(self.run())
+
+	async def close(self):
+		if self.worker is not None:
+			self.worker.cancel()
+
+		await super().close()
+
+	def send(self, channel, line):
+		self.append("log", channel.guild.id, channel.id, line)
+
+	async def send_dm(self, user, content, fallback, guild=None):
+		self.append("dm", guild.id if guild else None, user.id, content, [(channel.id, line) for channel, line in fallback])
+
+	def append(self, kind, guild_id, destination, content, fallback=None):
+		if len(self._pending) >= self.max_queue:
+			self.overflowed += 1
+			return
+
+		self._pending.append((kind, guild_id, destination, content, dumps(fallback) if fallback else None, datetime.utcnow()))
+
+		if self._writer is None:
+			self._writer = self.bot.loop.create_task(self.write())
+
+	async def write(self):
+		"""Writes pending rows to the outbox until there aren't any left, waking the worker after each batch."""
+
+		try:
+			while self._pending:
+				rows, self._pending = self._pending, []
 
-			else:
 				try:
-					await user_to_dm.send(self.dm_format(event, **options))
+					async with self.bot.postgres.acquire() as con:
+						query = """INSERT INTO outbox (kind, guild_id, destination, content, fallback, created_at, next_attempt_at)
+								   VALUES ($1, $2, $3, $4, $5::jsonb, $6, $6);"""
 
-				except:
-					failed_to_dm = True
+						await con.executemany(query, rows)
 
-		for log in logs:
-			if log is None:
+				except Exception:
+					self.bot.log.warning(f"Failed to write {len(rows)} rows to the outbox, retrying shortly.", exc_info=True)
+
+					# the oldest rows are kept if there's no longer room for all of them
+					self._pending = rows + self._pending
+					self.overflowed += max(len(self._pending) - self.max_queue, 0)
+					del self._pending[self.max_queue:]
+
+					await sleep(self.POLL_INTERVAL)
+					continue
+
+				self._wakeup.set()
+
+		finally:
+			self._writer = None
+
+	async def claim(self):
+		"""Leases the oldest rows that are due for delivery.
+		
+		Only rows for guilds on this process' shards are claimed, rows without a guild belong to shard 0."""
+
+		now = datetime.utcnow()
+		shard_count, shard_ids = shards(self.bot)
+
+		async with self.bot.postgres.acquire() as con:
+			query = """UPDATE outbox SET next_attempt_at = $1
+					   WHERE id IN (
+						   SELECT id FROM outbox
+						   WHERE next_attempt_at <= $2
+							   AND COALESCE((guild_id >> 22) % $4, 0) = ANY($5::int[])
+						   ORDER BY id LIMIT $3
+						   FOR UPDATE SKIP LOCKED
+					   )
+					   RETURNING id, kind, guild_id, destination, content, fallback, attempts, created_at;"""
+
+			rows = await con.fetch(query, now + timedelta(seconds=self.LEASE), now, self.CLAIM_SIZE, shard_count, shard_ids)
+
+		return sorted(rows, key=lambda r: r["id"])
+
+	async def run(self):
+		"""Delivers the outbox, waiting for new rows or retries to come due whenever it's empty."""
+
+		while True:
+			try:
+				rows = await self.claim()
+
+			except Exception:
+				self.bot.log.warning("Failed to claim rows from the outbox.", exc_info=True)
+				rows = []
+
+			if not rows:
+				self._wakeup.clear()
+
+				try:
+					await wait_for(self._wakeup.wait(), self.POLL_INTERVAL)
+
+				except TimeoutError:
+					pass
+
+				# give lines that arrive close together a chance to go out in the same message
+				await sleep(self.window)
 				continue
 
-			await log.send(self.log_format(event, **options))
-			if failed_to_dm:
-				await log.send(self.dm_fail_format(event, user_to_dm))
+			groups = {}
+			for row in rows:
+				groups.setdefault((row["kind"], row["destination"]), []).append(row)
+
+			results = await gather(*(self.deliver_group(kind, destination, group) for (kind, destination), group in groups.items()))
+
+			try:
+				await self.settle(
+					[row for done, _ in results for row in done],
+					[row for _, failed in results for row in failed]
+				)
+
+			except Exception:
+				self.bot.log.warning("Failed to settle delivered outbox rows, they'll be retried once their lease runs out.", exc_info=True)
+
+	async def deliver_group(self, kind, destination, rows):
+		"""Sends rows that share a destination and returns the ones that were dealt with and the ones that should be retried."""
+
+		if kind == "dm":
+			return await self.deliver_dms(destination, rows)
+
+		channel = self.bot.get_channel(destination)
+
+		if channel is None:
+			guild = self.bot.get_guild(rows[0]["guild_id"] or 0)
+
+			# the channel's only really gone if its guild is available, otherwise it's retried until it comes back
+			if guild is None or guild.unavailable:
+				return [], rows
+
+			return rows, []
+
+		done = []
+		pending = list(rows)
+
+		for chunk in self.batch(row["content"] for row in rows):
+			try:
+				await self.deliver(channel, "\n".join(chunk))
+
+			except discord.Forbidden:
+				return rows, []
+
+			except Exception:
+				self.bot.log.warning(f"Failed to send a batch of logs to {channel} ({channel.id}).", exc_info=True)
+				return done, pending
+
+			self.sent += 1
+
+			done += pending[:len(chunk)]
+			del pending[:len(chunk)]
+
+		return done, pending
+
+	async def deliver_dms(self, user_id, rows):
+		user = self.bot.get_user(user_id)
+		done = []
+
+		for index, row in enumerate(rows):
+			try:
+				if user is None:
+					user = await self.bot.fetch_user(user_id)
+
+				await user.send(row["content"])
+
+			except (discord.Forbidden, discord.NotFound):
+				# the user can't be DMed, so the log channels are told instead
+				for channel_id, line in loads(row["fallback"] or "[]"):
+					self.append("log", row["guild_id"], channel_id, line)
+
+			except Exception:
+				return done, rows[index:]
+
+			done.append(row)
+
+		return done, []
+
+	async def settle(self, done, failed):
+		"""Deletes delivered rows and schedules failed ones to be retried, or deletes them if they've been tried too many times."""
+
+		now = datetime.utcnow()
+		abandoned = [row for row in failed if row["attempts"] + 1 >= self.MAX_ATTEMPTS]
+		retried = [row for row in failed if row["attempts"] + 1 < self.MAX_ATTEMPTS]
+
+		# both happen or neither does, otherwise a failed settle could delete rows without retrying the rest
+		async with self.bot.postgres.acquire() as con:
+			async with con.transaction():
+				query = """DELETE FROM outbox WHERE id = ANY($1::bigint[]);"""
+				await con.execute(query, [row["id"] for row in done + abandoned])
+
+				query = """UPDATE outbox SET attempts = attempts + 1,
+						   next_attempt_at = $2::timestamp + make_interval(secs => LEAST(power(2, attempts), $3))
+						   WHERE id = ANY($1::bigint[]);"""
+
+				await con.execute(query, [row["id"] for row in retried], now, self.MAX_BACKOFF)
+
+		for row in done:
+			self.latency += (now - row["created_at"]).total_seconds()
+
+		self.delivered += len(done)
+		self.abandoned += len(abandoned)
+
+		if abandoned:
+			self.bot.log.warning(f"Gave up on delivering {len(abandoned)} rows from the outbox.")
+
+	async def stats(self):
+		async with self.bot.postgres.acquire() as con:
+			queued = await con.fetchval("""SELECT count(*) FROM outbox;""")
+
+		return {
+			"Queued": queued + len(self._pending),
+			"Delivered": self.delivered,
+			"Abandoned": self.abandoned,
+			"Average latency": f"{round(self.latency / self.delivered, 2) if self.delivered else 0}s",
+			"Messages sent": self.sent,
+			"Lines dropped": self.overflowed
+		}
 
 class Plugin(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
+		self.bot.action_templates = Templates(bot.actions)
+
+		config = self.bot.config.get("log_dispatcher", {})
+		dispatcher = OutboxDispatcher if config.get("outbox", False) else Dispatcher
+
+		ext.state.log_dispatcher = dispatcher(bot,
+			window=config.get("window", 1.0),
+			max_queue=config.get("max_queue", 500),
+			webhooks=config.get("webhooks", False)
+		)
+
+	def cog_unload(self):
+		self.bot.loop.create_task(ext.state.log_dispatcher.close())
+
+	@commands.Cog.listener()
+	async def on_ready(self):
+		if isinstance(ext.state.log_dispatcher, OutboxDispatcher):
+			ext.state.log_dispatcher.start()
 
 	@commands.Cog.listener()
 	async def on_message_edit(self, before, after):
@@ -100,7 +591,11 @@ class Plugin(commands.Cog):
 
 	@commands.Cog.listener()
 	async def on_raw_bulk_message_delete(self, payload):
-		log = await Handler.new(self.bot, payload.guild_id)
+		guild = self.bot.get_guild(payload.guild_id)
+		if guild is None:
+			return
+
+		log = await Handler.new(self.bot, guild)
 		await log.dispatch("MESSAGE_BULK_DELETE",
 			amount=len(payload.message_ids),
 			channel=self.bot.get_channel(payload.channel_id)
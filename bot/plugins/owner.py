@@ -1,5 +1,7 @@
 import discord
 
+import ext.state
+
 from discord.ext import commands
 from yaml import safe_load
 
@@ -32,6 +34,39 @@ class Plugin(commands.Cog):
 		await ctx.success("Shutting down, later taters!")
 		await self.bot.shutdown()
 
+	@control.command("cache",
+		usage="control cache"
+	)
+	async def control_cache(self, ctx):
+		"""Shows how effective the guild config cache has been."""
+
+		stats = self.bot.config_cache.stats
+		lookups = stats["hits"] + stats["misses"]
+		ratio = round(stats["hits"] / lookups * 100, 2) if lookups else 0
+
+		await ctx.send(f"🗃️ **Cached configs:** {stats['size']} | **Hits:** {stats['hits']} ({ratio}%) | **Misses:** {stats['misses']} | **Invalidations:** {stats['invalidations']} | **Deduplicated fetches:** {stats['coalesced']}")
+
+	@control.command("pipeline",
+		usage="control pipeline"
+	)
+	async def control_pipeline(self, ctx):
+		"""Shows how long each stage of auto-mod's message pipeline takes on average."""
+
+		timings = ext.state.auto_mod.timings
+		if not timings:
+			return await ctx.send("⏱️ No messages have been through the pipeline yet.")
+
+		await ctx.send("⏱️ **Message pipeline:**\n" + "\n".join(f"**{stage}:** {calls} runs, {round(total / calls * 1000, 3)} ms avg" for stage, (calls, total) in timings.items()))
+
+
+	@control.command("logs",
+		usage="control logs"
+	)
+	async def control_logs(self, ctx):
+		"""Shows how much the log dispatcher has sent, queued and dropped."""
+
+		stats = await ext.state.log_dispatcher.stats()
+		await ctx.send("📨 " + " | ".join(f"**{name}:** {value}" for name, value in stats.items()))
 
 def setup(bot):
 	bot.add_cog(Plugin(bot))
\ No newline at end of file
@@ -12,12 +12,11 @@ class Config:
 		raw = config.get("persistent_roles", {})
 		
 		self.enabled = raw.get("enabled", False)
-		self.whitelist = list(filter(None, [guild.get_role(r) for r in raw.get("whitelist", [])]))
+		self.whitelist = set(raw.get("whitelist", []))
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(guild, config))
 
 
 class Plugin(commands.Cog):
@@ -84,12 +83,12 @@ class Plugin(commands.Cog):
 			if not roles:
 				return
 
-		for role in literal_eval(roles):
-			role = member.guild.get_role(role)
-
-			if role not in config.whitelist:
+		for role_id in literal_eval(roles):
+			if role_id not in config.whitelist:
 				continue
 
+			role = member.guild.get_role(role_id)
+
 			if role in (None, member.guild.default_role):
 				continue
 
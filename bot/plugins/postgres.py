@@ -1,43 +1,259 @@
-import discord
+import discord, os
 
-from asyncpg import create_pool
+from asyncio import current_task, shield, sleep
+from asyncpg import connect, create_pool
 from discord.ext import commands
+from inspect import isawaitable
+from json import loads
 from yaml import safe_load
 
+from ext.cache import ConfigCache
+from ext.utils import int_keys
+
+# the web dashboard sends the ID of the guild whose config changed on this channel
+CONFIG_CHANNEL = "guild_configs"
+
+# migrations are named NNNN_description.sql and are applied in order of their number
+MIGRATIONS_PATH = "migrations"
+
+# the longest wait between attempts to resubscribe to config updates
+LISTEN_MAX_DELAY = 60
+
+# an arbitrary key for the advisory lock that stops two processes from migrating at the same time
+MIGRATION_LOCK = 0x63617074
+
 
 class Plugin(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
 
+		config = self.bot.config.get("config_cache", {})
+
+		self.bot.config_cache = ConfigCache(
+			size=config.get("size", 1000),
+			ttl=config.get("ttl", 300)
+		)
 		self.bot.get_config = self._get_config
+		self.bot.get_compiled = self._get_compiled
+
+		self._fetching = {}
+		self._listener = None
+		self._reconnect = None
+		self._closing = False
+
+	def cog_unload(self):
+		# closing the connection on purpose also calls its termination listeners, which would reconnect for an unloaded cog
+		self._closing = True
+
+		if self._reconnect is not None:
+			self._reconnect.cancel()
+
+		if self._listener is not None:
+			self._listener.remove_termination_listener(self._on_listener_lost)
+			self.bot.loop.create_task(self._listener.close())
 
 	async def _get_config(self, id):
+		if isinstance(id, discord.Guild):
+			id = id.id
+
+		config = self.bot.config_cache.get(id)
+		if config is not None:
+			return config
+
+		# one event fans out to lots of listeners that all want the same config at once,
+		# so they share a single fetch rather than each making their own round-trip
+		fetch = self._fetching.get(id)
+
+		if fetch is None:
+			fetch = self._fetching[id] = self.bot.loop.create_task(self._fetch_config(id))
+
+		else:
+			self.bot.config_cache.coalesced += 1
+
+		return await shield(fetch)
+
+	async def _fetch_config(self, id):
+		invalidations = self.bot.config_cache.invalidations
+
+		try:
+			# the dashboard validates the yaml and stores a pre-parsed copy when it's saved,
+			# so yaml is only touched for configs that were saved before the copy existed
+			async with self.bot.postgres.acquire() as con:
+				query = """SELECT parsed, config FROM guild_configs
+						   WHERE id = $1;"""
+
+				result = await con.fetchrow(query, id)
+
+		finally:
+			# an invalidation may have already swapped in a newer fetch
+			if self._fetching.get(id) is current_task():
+				del self._fetching[id]
+
+		if result is None:
+			config = {}
+
+		elif result["parsed"] is None:
+			config = safe_load(result["config"] or "") or {}
+
+		else:
+			config = loads(result["parsed"], object_pairs_hook=int_keys)
+
+		# if a config changed whilst we were fetching, what we have might already be stale
+		if invalidations == self.bot.config_cache.invalidations:
+			self.bot.config_cache.set(id, config)
+
+		return config
+
+	async def _get_compiled(self, guild, key, build):
+		"""Returns an object built from a guild's config, such as a plugin's Config class.
+
+		The object is only rebuilt when the guild's config changes or when one of its roles or channels are created or deleted,
+		otherwise the same instance is handed out again. build is called with the config dict and may return an awaitable."""
+
+		config = await self._get_config(guild)
+
+		# compiled objects live in the config's cache entry, so they're dropped when it's evicted, expires or is invalidated
+		compiled = self.bot.config_cache.compiled(guild.id, config)
+
+		if compiled is not None and key in compiled:
+			return compiled[key]
+
+		result = build(config)
+		if isawaitable(result):
+			result = await result
+
+		# the config may have been replaced whilst building
+		compiled = self.bot.config_cache.compiled(guild.id, config)
+		if compiled is not None:
+			compiled[key] = result
+
+		return result
+
+	@commands.Cog.listener("on_guild_role_create")
+	@commands.Cog.listener("on_guild_role_delete")
+	@commands.Cog.listener("on_guild_channel_create")
+	@commands.Cog.listener("on_guild_channel_delete")
+	async def drop_compiled(self, channel_or_role):
+		"""Compiled configs hold resolved roles and channels, so they have to be rebuilt when those change."""
+
+		self.bot.config_cache.drop_compiled(channel_or_role.guild.id)
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild):
+		self.bot.config_cache.invalidate(guild.id)
+
+	def _on_config_update(self, con, pid, channel, payload):
+		"""Drops a guild's cached config when the web dashboard notifies us that it has changed."""
+
+		try:
+			guild_id = int(payload)
+
+		except ValueError:
+			return self.bot.log.warn(f"Received a malformed config notification: {payload!r}")
+
+		self.bot.config_cache.invalidate(guild_id)
+		self._fetching.pop(guild_id, None)
+		self.bot.log.debug(f"Invalidated cached config for {guild_id}.")
+
+	def _on_listener_lost(self, con):
+		"""Wipes the cache and re-subscribes since we may have missed notifications whilst disconnected."""
+
+		if self._closing:
+			return
+
+		self.bot.log.warn("Lost the config notification connection, reconnecting.")
+		self.invalidate_all()
+
+		self._listener = None
+		self._reconnect = self.bot.loop.create_task(self.listen(reconnecting=True))
+
+	def invalidate_all(self):
+		self.bot.config_cache.invalidate()
+		self._fetching.clear()
+
+	async def listen(self, reconnecting=False):
+		"""Opens a dedicated connection that subscribes to config updates from the web dashboard.
+		
+		Failed attempts are retried with an increasing delay of up to LISTEN_MAX_DELAY seconds until one succeeds,
+		in the meantime cached configs only refresh once they expire."""
+
+		delay = 1
+
+		while not self._closing:
+			listener = None
+
+			try:
+				listener = await connect(self.bot.config["postgres"])
+
+				# the cog may have been unloaded whilst connecting
+				if self._closing:
+					return await listener.close()
+
+				await listener.add_listener(CONFIG_CHANNEL, self._on_config_update)
+
+			except Exception:
+				if listener is not None:
+					listener.terminate()
+
+				self.bot.log.error(f"Couldn't subscribe to config updates, trying again in {delay} seconds.",
+					exc_info=True
+				)
+
+				await sleep(delay)
+				delay = min(delay * 2, LISTEN_MAX_DELAY)
+
+				continue
+
+			listener.add_termination_listener(self._on_listener_lost)
+			self._listener = listener
+
+			# anything that changed whilst we weren't subscribed could still be cached
+			if reconnecting:
+				self.invalidate_all()
+
+			return self.bot.log.info("Subscribed to config updates.")
+
+	async def migrate(self):
+		"""Applies every migration in MIGRATIONS_PATH that hasn't been applied yet, oldest first.
+		
+		Each migration runs in its own transaction along with the schema_version row that records it,
+		so a migration that fails leaves the database at the last one that succeeded."""
+
 		async with self.bot.postgres.acquire() as con:
-			query = """SELECT config FROM guild_configs
-					   WHERE id = $1;"""
+			query = """CREATE TABLE IF NOT EXISTS schema_version (version INT PRIMARY KEY, name TEXT, applied_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'));"""
+			await con.execute(query)
+
+			await con.execute("""SELECT pg_advisory_lock($1);""", MIGRATION_LOCK)
+
+			try:
+				applied = {r["version"] for r in await con.fetch("""SELECT version FROM schema_version;""")}
+
+				for name in sorted(f for f in os.listdir(MIGRATIONS_PATH) if f.endswith(".sql")):
+					version = int(name.split("_", 1)[0])
 
-			if isinstance(id, discord.Guild):
-				id = id.id
+					if version in applied:
+						continue
 
-			result = await con.fetchval(query, id)
-			if result is None:
-				return {}
+					with open(os.path.join(MIGRATIONS_PATH, name), encoding="utf-8") as file:
+						migration = file.read()
 
-			return safe_load(result)
+					async with con.transaction():
+						await con.execute(migration)
+
+						query = """INSERT INTO schema_version (version, name) VALUES ($1, $2);"""
+						await con.execute(query, version, name)
+
+					self.bot.log.info(f"Applied database migration {name}.")
+
+			finally:
+				await con.execute("""SELECT pg_advisory_unlock($1);""", MIGRATION_LOCK)
 
 	@commands.Cog.listener()
 	async def on_postgres_connect(self):
-		"""Handles the creation of required tables when the connection is established."""
+		"""Brings the database schema up to date when the connection is established."""
 
-		async with self.bot.postgres.acquire() as con:
-			queries = ("""CREATE TABLE IF NOT EXISTS infractions (id SERIAL PRIMARY KEY, guild_id BIGINT, actor_id BIGINT, target_id BIGINT, type_id BIGINT, reason TEXT, created_at TIMESTAMP);""",
-                       """CREATE TABLE IF NOT EXISTS timers (id SERIAL PRIMARY KEY, event TEXT, expire_at TIMESTAMP, extras JSONB);""",
-                       """CREATE TABLE IF NOT EXISTS persistent_roles (id SERIAL PRIMARY KEY, user_id BIGINT, guild_id BIGINT, role_ids TEXT, CONSTRAINT unique_user_guild UNIQUE (user_id, guild_id));""",
-                       """CREATE TABLE IF NOT EXISTS starboard_messages (id SERIAL PRIMARY KEY, guild_id BIGINT, starboard_id BIGINT, channel_id BIGINT, message_id BIGINT, created_at TIMESTAMP);""",
-					   """CREATE TABLE IF NOT EXISTS message_archives (id SERIAL PRIMARY KEY, cdn_url TEXT, key TEXT);""")
-
-			for query in queries:
-				await con.execute(query)
+		await self.migrate()
+		await self.listen()
 
 def setup(bot):
 	if bot.config is None:
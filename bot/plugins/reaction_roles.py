@@ -2,8 +2,6 @@ import discord
 
 from discord.ext import commands
 
-from ext.utils import first
-
 
 class Config:
 	def __init__(self, guild, config):
@@ -12,12 +10,11 @@ class Config:
 		self.enabled = raw.get("enabled", False)
 		self.channel = guild.get_channel(raw.get("channel"))
 		self.message_id = raw.get("message")
-		self.roles = {guild.get_role(r): e for r, e in raw.get("roles", {}).items()}
+		self.roles = {e: guild.get_role(r) for r, e in raw.get("roles", {}).items()}
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(guild, config))
 
 	async def message(self):
 		if self.channel is not None:
@@ -30,12 +27,7 @@ class Config:
 		return None
 
 	def get_for(self, emoji):
-		search_result = first(self.roles.items(), lambda r: r[1] == str(emoji))
-
-		if search_result is None:
-			return None
-
-		return search_result[0]
+		return self.roles.get(str(emoji))
 
 class Plugin(commands.Cog):
 	def __init__(self, bot):
@@ -44,10 +36,10 @@ class Plugin(commands.Cog):
 	@commands.Cog.listener("on_raw_reaction_add")
 	@commands.Cog.listener("on_raw_reaction_remove")
 	async def on_raw_reaction_add_remove(self, payload):
-		if payload.guild_id is None:
+		guild = self.bot.get_guild(payload.guild_id)
+		if guild is None:
 			return
 
-		guild = self.bot.get_guild(payload.guild_id)
 		config = await Config.new(self.bot, guild)
 
 		if payload.message_id != config.message_id or not config.enabled:
@@ -1,23 +1,30 @@
 import discord
 
 from discord.ext import commands
-from redis import Redis
+from redis.asyncio import BlockingConnectionPool, Redis
 
 
 def setup(bot: commands.Bot):
 	if bot.config is None:
 		return bot.log.warn("Can't connect to Redis, reason: no external config file.")
 
+	if bot.config.get("rate_limiter", "redis") != "redis":
+		return bot.log.info("Not connecting to Redis, reason: the local rate limiter is being used.")
+
 	config = bot.config.get("redis", {})
 
 	try:
+		# a blocking pool makes callers wait for a free connection rather than erroring when it's exhausted
 		bot.redis = Redis(
-			host=config.get("host", "127.0.0.1"),
-			port=config.get("port", "6379"),
-			password=config.get("password"),
-			db=config.get("database", 0)
+			connection_pool=BlockingConnectionPool(
+				host=config.get("host", "127.0.0.1"),
+				port=config.get("port", "6379"),
+				password=config.get("password"),
+				db=config.get("database", 0),
+				max_connections=config.get("max_connections", 10)
+			)
 		)
-		bot.redis.ping()
+		bot.loop.run_until_complete(bot.redis.ping())
 
 		bot.log.info("Successfully connected to Redis server.")
 
@@ -104,7 +104,7 @@ class Plugin(commands.Cog, name="Reminders"):
 	async def reminder_list(self, ctx):
 		"""Lists all of a user's currently running reminders."""
 
-		timers = state.timer_handler.get_all("reminder", {"user_id": ctx.author.id})
+		timers = await state.timer_handler.get_all("reminder", {"user_id": ctx.author.id})
 		if not timers:
 			raise LookupFailed("reminders")
 		
@@ -120,7 +120,7 @@ class Plugin(commands.Cog, name="Reminders"):
 	):
 		"""Cancels a currently running reminder."""
 
-		timer = state.timer_handler.get("reminder", id)
+		timer = await state.timer_handler.get("reminder", id)
 		if timer is None:
 			raise LookupFailed("reminders")
 	
@@ -4,7 +4,6 @@ from discord.ext import commands
 
 from ext.exceptions import CustomException, MissingSubcommand
 from ext.state import access_control
-from ext.utils import first
 
 
 class CannotSync(CustomException):
@@ -37,12 +36,11 @@ class Config:
 
 		self.enabled = raw.get("enabled", False)
 		self.sync_on = raw.get("sync_on", [])
-		self.flags = [Flag(guild, f, r) for f, r in raw.get("flags", {}).items()]
+		self.flags = {f: Flag(guild, f, r) for f, r in raw.get("flags", {}).items()}
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 	async def sync(self, member, flag_override=None):
 		ALL_FLAGS = [1, 2, 4, 8, 64, 128, 256, 512, 16384, 131072]
@@ -76,47 +74,47 @@ class Config:
 		return len(assign), len(remove)
 
 	def get(self, flag):
-		return first(self.flags, lambda f: f.flag == flag)
+		return self.flags.get(flag)
 
 	@property
 	def staff(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.STAFF)
+		return self.get(FlagEnum.STAFF)
 	
 	@property
 	def partner(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.PARTNER)
+		return self.get(FlagEnum.PARTNER)
 
 	@property
 	def events(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.HS_EVENTS)
+		return self.get(FlagEnum.HS_EVENTS)
 
 	@property
 	def hunter(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.BUG_HUNTER_1)
+		return self.get(FlagEnum.BUG_HUNTER_1)
 
 	@property
 	def bravery(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.HS_BRAVERY)
+		return self.get(FlagEnum.HS_BRAVERY)
 
 	@property
 	def brilliance(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.HS_BRILLIANCE)
+		return self.get(FlagEnum.HS_BRILLIANCE)
 
 	@property
 	def balance(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.HS_BALANCE)
+		return self.get(FlagEnum.HS_BALANCE)
 
 	@property
 	def early_supporter(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.EARLY_SUPPORTER)
+		return self.get(FlagEnum.EARLY_SUPPORTER)
 
 	@property
 	def gold_hunter(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.BUG_HUNTER_2)
+		return self.get(FlagEnum.BUG_HUNTER_2)
 
 	@property
 	def verified_dev(self):
-		return first(self.flags, lambda f: f.flag == FlagEnum.VERIFIED_BOT_DEV)
+		return self.get(FlagEnum.VERIFIED_BOT_DEV)
 
 
 class Plugin(commands.Cog, name="Roles for Badges"):
@@ -99,28 +99,26 @@ class Config:
 	def __init__(self, bot, guild, config):
 		raw = config.get("starboard", {})
 
+		self.guild = guild
+
 		self.enabled = raw.get("enabled", False)
 		self.emoji = raw.get("emoji", "⭐")
 		self.required = raw.get("required_stars", 3)
 		self.channel = bot.get_channel(raw.get("channel"))
 
-		self.ignored_roles = list(filter(None, [guild.get_role(r) for r in raw.get("ignored_roles", [])]))
-		self.ignored_channels = list(filter(None, [guild.get_channel(c) for c in raw.get("ignored_channels", [])]))
+		self.ignored_roles = set(raw.get("ignored_roles", []))
+		self.ignored_channels = set(raw.get("ignored_channels", []))
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
-	def is_ignored(self, user, channel):
-		if channel in self.ignored_channels:
+	def is_ignored(self, user, channel=None):
+		if channel is not None and channel.id in self.ignored_channels:
 			return True
 
-		for r in self.ignored_roles:
-			if r in user.roles:
-				return True
-
-		return False
+		# users that have left the server don't have any roles to check
+		return bool(self.ignored_roles) and any(r.id in self.ignored_roles for r in getattr(user, "roles", ()))
 
 
 class Plugin(commands.Cog):
@@ -129,10 +127,11 @@ class Plugin(commands.Cog):
 
 	@commands.Cog.listener()
 	async def on_raw_message_delete(self, payload):
-		if payload.guild_id is None:
+		guild = self.bot.get_guild(payload.guild_id)
+		if guild is None:
 			return
 
-		config = await Config.new(self.bot, payload.guild_id)
+		config = await Config.new(self.bot, guild)
 
 		if not config.enabled or config.channel is None or payload.channel_id == config.channel.id:
 			return
@@ -163,10 +162,11 @@ class Plugin(commands.Cog):
 	@commands.Cog.listener("on_raw_reaction_add")
 	@commands.Cog.listener("on_raw_reaction_remove")
 	async def update_starboard(self, payload):
-		if payload.guild_id is None:
+		guild = self.bot.get_guild(payload.guild_id)
+		if guild is None:
 			return
 
-		config = await Config.new(self.bot, payload.guild_id)
+		config = await Config.new(self.bot, guild)
 
 		if not config.enabled or config.channel is None or str(payload.emoji) != config.emoji or payload.channel_id == config.channel.id:
 			return
@@ -206,7 +206,7 @@ class Plugin(commands.Cog):
 
 				return await _delete(starboard_message)
 
-			stars = len([starrer for starrer in await star_reaction[0].users().flatten() if starrer != message.author and not [r for r in starrer.roles if r in config.ignored_roles]])
+			stars = len([starrer for starrer in await star_reaction[0].users().flatten() if starrer != message.author and not config.is_ignored(starrer)])
 			if stars < config.required:
 				if starboard_message:
 					await _delete(starboard_message)
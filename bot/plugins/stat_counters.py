@@ -16,8 +16,7 @@ class Config:
 
 	@classmethod
 	async def new(cls, bot, guild):
-		config = await bot.get_config(guild)
-		return cls(bot, guild, config)
+		return await bot.get_compiled(guild, cls, lambda config: cls(bot, guild, config))
 
 	def get(self, events):
 		return [c for c in self.counters if c.event in events]
@@ -2,15 +2,26 @@ import discord
 
 import ext.state
 
-from asyncio import sleep
+from asyncio import Event, TimeoutError, gather, wait_for
+from asyncpg import InterfaceError, PostgresError
+from collections import deque
 from datetime import datetime, timedelta
-from discord.ext import commands
+from discord.ext import commands, tasks
+from heapq import heapify, heappop, heappush
+from itertools import count
 from json import dumps, loads
+from uuid import uuid4
 
-from ext.utils import first
+from ext.utils import first, shards
 
 EVENT_BASE = "{}_expire"
 
+# the extras that say who or what a timer is for, the first one a timer has is used to index it
+PRINCIPAL_KEYS = ("target_id", "user_id", "channel_id")
+
+# we can only sleep reliably for 48 days at a time, let's cap it at 45 just to be safe
+MAX_SLEEP = 86400 * 45
+
 class Timer:
 	def __init__(self, bot, **timer_data):
 		self.bot = bot
@@ -22,17 +33,40 @@ class Timer:
 		self.expire_at = timer_data.pop("expire_at")
 
 		self.cancelled = False
+		self.expired = False
+
+		# the scheduler's current heap entry for this timer, anything else left in the heap for it is stale
+		self._entry = None
+
+	@property
+	def key(self):
+		"""The (event, guild_id, principal) tuple this timer is indexed by."""
+
+		return index_key(self.event, self.extras)
+
+	@classmethod
+	def from_record(cls, bot, record):
+		"""Creates a timer from a row of the timers table."""
+
+		return cls(bot,
+			id=record["id"],
+			event=record["event"],
+			expire_at=record["expire_at"],
+			extras=loads(record["extras"])
+		)
 
 	@classmethod
-	async def create(cls, bot, event, expire_at, extras):
+	async def create(cls, bot, event, expire_at, extras, guild_id=None, lease_owner=None, lease_expires=None):
 		"""Creates a running timer and inserts it into the database.
 		
-		The extras dict has to be serialised into a string so that Postgres can store it."""
+		The extras dict has to be serialised into a string so that Postgres can store it.
+		If lease_owner is provided, the timer is inserted already leased to that process."""
 
 		async with bot.postgres.acquire() as con:
-			query = """INSERT INTO timers (event, expire_at, extras) VALUES ($1, $2, $3::jsonb) RETURNING id;"""
+			query = """INSERT INTO timers (event, expire_at, extras, guild_id, lease_owner, lease_expires)
+					   VALUES ($1, $2, $3::jsonb, $4, $5, $6) RETURNING id;"""
 
-			id = await con.fetchval(query, event, expire_at, dumps(extras))
+			id = await con.fetchval(query, event, expire_at, dumps(extras), guild_id, lease_owner, lease_expires)
 
 		return cls(bot,
 			id=id,
@@ -51,49 +85,26 @@ class Timer:
 			query = """UPDATE timers SET expire_at = $1 WHERE id = $2;"""
 			await con.execute(query, new_time, self.id)
 
-		self.bot.log.debug(f"Extended timer {self.id} to {new_time}.")
-
-	async def start(self):
-		"""Starts the current timeout.
-		
-		If the timer expires, it dispatches an event with all of the extra data."""
-
-		past_expire = self.expire_at
-		duration = (past_expire - datetime.utcnow()).total_seconds()
-
-		# we can only sleep reliably for 48 days at a time, let's cap it at 45 just to be safe
-		if duration >= 86400 * 45:
-			diff = duration - 86400 * 45
-			duration -= diff
-			await sleep(diff)
-
-		await sleep(duration)
-
-		if self.cancelled:
-			return
-
-		if past_expire != self.expire_at:
-			return await self.start()
+		await ext.state.timer_handler.reschedule(self)
 
-		await self.remove()
-		self.dispatch()
-		ext.state.timer_handler.running_timers.remove(self)
+		self.bot.log.debug(f"Extended timer {self.id} to {new_time}.")
 
 	async def cancel(self, remove_cache=True):
-		"""This cancels the current task.
+		"""This cancels the current timer.
 		
-		It doesn't actually interrupt the timeout, it just wipes it from the database and prevents the event from being fired
-		if the timer ends.
+		It wipes it from the database and the scheduler so that the event is never fired.
 		
 		If remove_cache is provided then the timer is removed from the Timer framework's list of existing timers."""
 
 		self.bot.log.debug(f"Timer {self.id} with event {EVENT_BASE.format(self.event)} has been cancelled.")
 
 		self.cancelled = True
+		ext.state.timer_handler.unschedule(self)
+
 		await self.remove()
 
 		if remove_cache:
-			ext.state.timer_handler.running_timers.remove(self)
+			ext.state.timer_handler.untrack(self)
 
 	async def remove(self):
 		"""This removes the timer from the database."""
@@ -127,62 +138,437 @@ class Timer:
 class Plugin(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
-		self.running_timers = []
 
-	@commands.Cog.listener()
-	async def on_ready(self):
-		"""This handles the starting of every timer that remains in the database."""
+		# timers that are in memory, indexed by their ID and by their key so neither lookup has to scan every timer
+		self._by_id = {}
+		self._by_key = {}
+
+		# only timers expiring before loaded_until are kept in memory, the rest are paged in as the horizon moves forward
+		config = bot.config.get("timers", {})
+
+		self.horizon = timedelta(seconds=config.get("horizon", 3600))
+		self.catch_up_workers = config.get("catch_up_workers", 5)
+		self.loaded_until = None
+		self.pager.change_interval(seconds=self.horizon.total_seconds() / 2)
+
+		# tasks.loop only retries on network errors by default, so a dropped connection would otherwise stop paging for good
+		self.pager.add_exception_type(PostgresError, InterfaceError)
+
+		# timers are leased to a single process so that several of them can share the table without firing a timer twice
+		# leases last for a horizon and are renewed every time the pager runs, so a dead process' timers are taken over soon after
+		self.owner = uuid4().hex
+
+		# a min-heap of (expire_at, sequence, timer) entries, the sequence breaks ties between timers that expire together
+		# extending or cancelling a timer leaves its old entry behind, which is skipped once it reaches the top
+		self._heap = []
+		self._sequence = count()
+		self._stale = 0
+		self._wakeup = Event()
+
+		self.scheduler = bot.loop.create_task(self.run())
+
+	def cog_unload(self):
+		self.scheduler.cancel()
+		self.pager.cancel()
+
+	def track(self, timer, schedule=True):
+		"""Keeps a timer in memory and schedules it, unless schedule is False.
+		
+		Returns False if a timer with the same ID is already being tracked."""
+
+		if timer.id in self._by_id:
+			return False
+
+		self._by_id[timer.id] = timer
+		self._by_key.setdefault(timer.key, {})[timer.id] = timer
+
+		if schedule:
+			self.schedule(timer)
+
+		return True
+
+	def untrack(self, timer):
+		"""Forgets about a timer that's being kept in memory."""
+
+		if self._by_id.get(timer.id) is timer:
+			del self._by_id[timer.id]
+
+			timers = self._by_key[timer.key]
+			del timers[timer.id]
+
+			if not timers:
+				del self._by_key[timer.key]
+
+		self.unschedule(timer)
+
+	async def reschedule(self, timer):
+		"""Moves a timer to its new expiry time after it's been extended.
+		
+		Timers that were only in the database are brought into memory if they now expire within the loaded horizon
+		and no other process holds a lease on them."""
+
+		if timer._entry is not None:
+			return self.schedule(timer)
+
+		if timer.cancelled or timer.expired or self.loaded_until is None:
+			return
+
+		if timer.expire_at >= self.loaded_until:
+			return
 
 		async with self.bot.postgres.acquire() as con:
-			query = """SELECT id, event, expire_at, extras FROM timers;"""
-			timers = await con.fetch(query)
+			query = """UPDATE timers SET lease_owner = $1, lease_expires = $2
+					   WHERE id = $3 AND (lease_owner IS NULL OR lease_owner = $1 OR lease_expires < $4);"""
+
+			status = await con.execute(query, self.owner, self.lease_expiry(), timer.id, datetime.utcnow())
+
+		if status != "UPDATE 0":
+			self.track(timer)
+
+	def lease_expiry(self):
+		return datetime.utcnow() + self.horizon
+
+	@property
+	def shards(self):
+		"""The shard count and the IDs of the shards this process is running."""
+
+		return shards(self.bot)
+
+	def schedule(self, timer):
+		"""Adds a timer to the scheduler or moves it to its current expiry time if it's already scheduled."""
+
+		if timer._entry is not None:
+			self._stale += 1
+
+		timer._entry = entry = (timer.expire_at, next(self._sequence), timer)
+		heappush(self._heap, entry)
+
+		# only the earliest timer decides how long the scheduler sleeps for
+		if self._heap[0] is entry:
+			self._wakeup.set()
+
+		self.compact()
+
+	def unschedule(self, timer):
+		"""Stops a timer from ever being fired by the scheduler."""
+
+		if timer._entry is not None:
+			timer._entry = None
+			self._stale += 1
+
+		self.compact()
+
+	def compact(self):
+		"""Rebuilds the heap without its stale entries once they make up more than half of it."""
+
+		if self._stale <= 1000 or self._stale * 2 <= len(self._heap):
+			return
+
+		self._heap = [entry for entry in self._heap if entry[2]._entry is entry]
+		heapify(self._heap)
+
+		self._stale = 0
+
+	def next_due(self):
+		"""Returns the heap entry for the earliest timer, dropping any stale entries in front of it."""
+
+		while self._heap and self._heap[0][2]._entry is not self._heap[0]:
+			heappop(self._heap)
+			self._stale -= 1
+
+		return self._heap[0] if self._heap else None
+
+	async def run(self):
+		"""Fires every timer once it expires.
+		
+		This is a single task that only ever sleeps until the earliest timer is due, or until a new earlier timer is scheduled."""
+
+		while True:
+			self._wakeup.clear()
+			entry = self.next_due()
+
+			if entry is None:
+				await self._wakeup.wait()
+				continue
 
-		if not timers:
-			return self.bot.log.info("There were no timers that needed starting.")
+			duration = (entry[0] - datetime.utcnow()).total_seconds()
 
-		self.bot.log.info(f"Attempting to start {len(timers)} timers.")
-		for timer in timers:
-			new_timer = Timer(self.bot,
-				id=timer["id"],
-				event=timer["event"],
-				expire_at=timer["expire_at"],
-				extras=loads(timer["extras"])
-			)
+			if duration > 0:
+				try:
+					await wait_for(self._wakeup.wait(), min(duration, MAX_SLEEP))
 
-			self.running_timers.append(new_timer)
-			self.bot.log.debug(f"Successfully started a timer for {EVENT_BASE.format(timer['event'])}")
+				except TimeoutError:
+					pass
 
-			self.bot.loop.create_task(new_timer.start())
+				continue
 
-		self.bot.log.info(f"Successfully started {len(self.running_timers)}/{len(timers)} timers.")
+			heappop(self._heap)
+			timer = entry[2]
+			timer._entry = None
+			timer.expired = True
+
+			self.untrack(timer)
+			self.bot.loop.create_task(self.fire(timer))
+
+	async def fire(self, timer):
+		"""Removes an expired timer from the database and dispatches its event.
+		
+		The event is only dispatched if this process still holds the timer's lease when it's removed.
+		If the removal fails, the timer is left for whichever process picks up its lease next."""
+
+		try:
+			async with self.bot.postgres.acquire() as con:
+				query = """DELETE FROM timers WHERE id = $1 AND lease_owner = $2;"""
+				status = await con.execute(query, timer.id, self.owner)
+
+		except Exception:
+			return self.bot.log.exception(f"Failed to remove timer {timer.id} from the database.")
+
+		if status == "DELETE 0":
+			return self.bot.log.debug(f"Timer {timer.id} was removed or taken over by another process before it fired.")
+
+		timer.dispatch()
+
+	async def page_in(self):
+		"""Leases and loads every timer that expires before the end of the horizon and hasn't already been loaded.
+		
+		Only timers for guilds on this process' shards are claimed, timers without a guild belong to shard 0.
+		Timers leased to another process are skipped until that lease runs out, which also renews every lease this process holds."""
+
+		since, until = self.loaded_until, datetime.utcnow() + self.horizon
+		shard_count, shard_ids = self.shards
+
+		# timers created from here on that expire before the new horizon are tracked straight away
+		self.loaded_until = until
+
+		try:
+			async with self.bot.postgres.acquire() as con:
+				async with con.transaction():
+					query = """UPDATE timers SET lease_expires = $2 WHERE lease_owner = $1;"""
+					await con.execute(query, self.owner, self.lease_expiry())
+
+					query = """UPDATE timers SET lease_owner = $1, lease_expires = $2
+							   WHERE id IN (
+								   SELECT id FROM timers
+								   WHERE expire_at < $3
+									   AND (lease_owner IS NULL OR lease_owner = $1 OR lease_expires < $4)
+									   AND COALESCE((guild_id >> 22) % $5, 0) = ANY($6::int[])
+								   FOR UPDATE SKIP LOCKED
+							   )
+							   RETURNING id, event, expire_at, extras;"""
+
+					records = await con.fetch(query, self.owner, self.lease_expiry(), until, datetime.utcnow(), shard_count, shard_ids)
+
+		except Exception:
+			self.loaded_until = since
+			raise
+
+		now = datetime.utcnow()
+		loaded, overdue = [], []
+
+		for timer in (Timer.from_record(self.bot, r) for r in records):
+			# anything that expired while the bot was offline, or while its last owner was, is left for catch_up
+			late = timer.expire_at <= now
+
+			if self.track(timer, schedule=not late):
+				(overdue if late else loaded).append(timer)
+
+		return loaded, overdue
+
+	@tasks.loop(seconds=1800)
+	async def pager(self):
+		"""Pages in the timers that have moved inside of the horizon since the last run."""
+
+		first_run = self.loaded_until is None
+		timers, overdue = await self.page_in()
+
+		if overdue:
+			self.bot.loop.create_task(self.catch_up(overdue))
+
+		if first_run:
+			if not timers and not overdue:
+				return self.bot.log.info("There were no timers that needed starting.")
+
+			return self.bot.log.info(f"Successfully started {len(timers)} timers expiring before {self.loaded_until}.")
+
+		self.bot.log.debug(f"Paged in {len(timers)} timers expiring before {self.loaded_until}.")
+
+	def guild_of(self, extras):
+		"""Returns the ID of the guild a timer with these extras belongs to, if there is one."""
+
+		if "guild_id" in extras:
+			return extras["guild_id"]
+
+		channel = self.bot.get_channel(extras.get("channel_id"))
+		return getattr(getattr(channel, "guild", None), "id", None)
+
+	async def catch_up(self, timers):
+		"""Fires the timers that expired while the bot was offline.
+		
+		Each guild's overdue timers are queued oldest first and the queues are taken from in turn,
+		so a guild with a large backlog can't hold up the rest. Only catch_up_workers timers are fired at a time,
+		and their listeners are awaited directly so that the limit actually holds."""
+
+		queues = {}
+		for timer in sorted(timers, key=lambda t: t.expire_at):
+			queues.setdefault(self.guild_of(timer.extras), deque()).append(timer)
+
+		order = []
+		while queues:
+			for guild_id, queue in list(queues.items()):
+				order.append(queue.popleft())
+
+				if not queue:
+					del queues[guild_id]
+
+		try:
+			async with self.bot.postgres.acquire() as con:
+				query = """DELETE FROM timers WHERE id = ANY($1::int[]) AND lease_owner = $2 RETURNING id;"""
+				removed = {r["id"] for r in await con.fetch(query, [t.id for t in order], self.owner)}
+
+		except Exception:
+			# forgetting about them lets the next page in track and catch up on them again
+			for timer in order:
+				self.untrack(timer)
+
+			return self.bot.log.exception(f"Failed to remove {len(order)} overdue timers, they'll be retried when the pager next runs.")
+
+		# anything that wasn't removed has been cancelled or taken over by another process in the meantime
+		for timer in order:
+			if timer.id not in removed:
+				self.untrack(timer)
+
+		order = [t for t in order if t.id in removed]
+
+		self.bot.log.info(f"Catching up on {len(order)} overdue timers.")
+
+		pending = iter(order)
+		done = 0
+
+		async def worker():
+			nonlocal done
+
+			for timer in pending:
+				try:
+					if not timer.cancelled:
+						timer.expired = True
+						self.untrack(timer)
+
+						await self.run_listeners(timer)
+
+				except Exception:
+					self.bot.log.exception(f"Failed to catch up on timer {timer.id}.")
+
+				finally:
+					self.untrack(timer)
+
+				done += 1
+				if done % 100 == 0:
+					self.bot.log.info(f"Caught up on {done}/{len(order)} overdue timers.")
+
+		await gather(*(worker() for _ in range(self.catch_up_workers)))
+		self.bot.log.info(f"Finished catching up on {len(order)} overdue timers.")
+
+	async def run_listeners(self, timer):
+		"""Runs every listener for a timer's event and waits for them to finish, unlike Timer.dispatch."""
+
+		self.bot.log.debug(f"Dispatched timer {timer.id} with event {EVENT_BASE.format(timer.event)}.")
+
+		for listener in list(self.bot.extra_events.get("on_" + EVENT_BASE.format(timer.event), ())):
+			try:
+				await listener(**timer.extras)
+
+			except Exception:
+				self.bot.log.exception(f"Listener {listener.__qualname__} failed for timer {timer.id}.")
+
+	@commands.Cog.listener()
+	async def on_ready(self):
+		"""This starts paging in the timers that remain in the database."""
+
+		if not self.pager.is_running():
+			self.pager.start()
 
 	async def new(self, **timer_args):
-		"""Creates a new timer and adds it to the cog's cache."""
+		"""Creates a new timer and adds it to the cog's cache.
+		
+		Timers that expire past the loaded horizon are only stored in the database until they're paged in."""
+
+		expire_at = timer_args.get("expire_at")
+		extras = timer_args.get("extras")
+
+		# timers that'll be kept in memory are leased to this process straight away
+		tracked = self.loaded_until is not None and expire_at < self.loaded_until
 
 		new_timer = await Timer.create(self.bot,
 			event=timer_args.get("event"),
-			expire_at=timer_args.get("expire_at"),
-			extras=timer_args.get("extras")
+			expire_at=expire_at,
+			extras=extras,
+			guild_id=self.guild_of(extras),
+			lease_owner=self.owner if tracked else None,
+			lease_expires=self.lease_expiry() if tracked else None
 		)
 
-		self.running_timers.append(new_timer)
-		self.bot.log.debug(f"Successfully started a timer for {EVENT_BASE.format(timer_args.get('event'))}")
-		self.bot.loop.create_task(new_timer.start())
+		if tracked:
+			self.track(new_timer)
 
+		else:
+			# the horizon may have moved past this timer while it was being inserted
+			await self.reschedule(new_timer)
+
+		self.bot.log.debug(f"Successfully created a timer for {EVENT_BASE.format(timer_args.get('event'))}")
 		return new_timer
 
-	def get(self, event, query):
-		"""Searches for a running timer with a particular event by an extras value or ID."""
+	async def get(self, event, search):
+		"""Searches for a timer with a particular event by an extras value or ID.
+		
+		Timers that haven't been paged in yet are looked up in the database."""
+
+		if isinstance(search, int):
+			timer = self._by_id.get(search)
+
+			if timer is not None and timer.event == event:
+				return timer
+
+		else:
+			key = index_key(event, search)
+			candidates = self._by_key.get(key, {}).values() if key[2] is not None else self._by_id.values()
+
+			timer = first(candidates, lambda timer_set: all(item in timer_set.extras.items() for item in search.items()) and timer_set.event == event)
+
+			if timer is not None:
+				return timer
+
+		async with self.bot.postgres.acquire() as con:
+			if isinstance(search, int):
+				query = """SELECT id, event, expire_at, extras FROM timers WHERE id = $1 AND event = $2;"""
+				record = await con.fetchrow(query, search, event)
+
+			else:
+				query = """SELECT id, event, expire_at, extras FROM timers WHERE event = $1 AND extras @> $2::jsonb LIMIT 1;"""
+				record = await con.fetchrow(query, event, dumps(search))
+
+		if record is None:
+			return None
+
+		return self._by_id.get(record["id"]) or Timer.from_record(self.bot, record)
+
+	async def get_all(self, event, search):
+		"""Returns all timers that match the provided query, whether they've been paged in or not."""
+
+		async with self.bot.postgres.acquire() as con:
+			query = """SELECT id, event, expire_at, extras FROM timers WHERE event = $1 AND extras @> $2::jsonb ORDER BY expire_at;"""
+			records = await con.fetch(query, event, dumps(search))
 
-		if isinstance(query, int):
-			return first(self.running_timers, lambda timer_set: timer_set.id == query and timer_set.event == event)
+		return [self._by_id.get(r["id"]) or Timer.from_record(self.bot, r) for r in records]
 
-		return first(self.running_timers, lambda timer_set: all(item in timer_set.extras.items() for item in query.items()) and timer_set.event == event)
+def index_key(event, extras):
+	"""Returns the (event, guild_id, principal) tuple used to index timers with these extras.
+	
+	The principal is the first of PRINCIPAL_KEYS that's present, or None if there isn't one."""
 
-	def get_all(self, event, query):
-		"""Returns all running timers that match the provided query."""
+	principal = first(PRINCIPAL_KEYS, lambda key: key in extras)
 
-		return [t for t in self.running_timers if all(item in t.extras.items() for item in query.items()) and t.event == event]
+	return event, extras.get("guild_id"), extras.get(principal)
 
 def setup(bot):
 	ext.state.timer_handler = cog = Plugin(bot)
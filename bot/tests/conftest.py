@@ -0,0 +1,4 @@
+import os, sys
+
+# the bot imports its modules relative to the bot directory, the same as when it's run with python bot.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
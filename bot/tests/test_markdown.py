@@ -0,0 +1,15 @@
+import json, os, pytest
+
+from ext.markdown import format_content_html
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "data", "format_content_html.json")
+
+with open(GOLDEN_PATH, encoding="utf-8") as file:
+	CASES = json.load(file)
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_format_content_html(case):
+	"""Every input in the golden corpus is rendered exactly as it was when the corpus was recorded."""
+
+	assert format_content_html(case["input"], case["allow_links"]) == case["output"]
@@ -1,4 +1,5 @@
 from functools import wraps
+from json import dumps
 from yaml import safe_load
 
 from ext.exceptions import RequiresAuth
@@ -10,6 +11,45 @@ class WebAccessEnum:
 	EDITOR = 0
 	VIEWER = 1
 
+def parse_config(text):
+	"""Validates a yaml config and returns the canonical JSON copy that gets stored alongside it.
+
+	JSON only allows string keys, so ID keys (e.g. channels in logs) are stringified here and turned back into ints by the bot.
+	Raises ValueError if the config isn't a yaml mapping."""
+
+	config = safe_load(text) if text else {}
+
+	if config is None:
+		config = {}
+
+	if not isinstance(config, dict):
+		raise ValueError("The config must be a mapping.")
+
+	return dumps(config, default=str)
+
+def migrate_configs(db):
+	"""Fills in the pre-parsed copy of any config that was saved before it existed."""
+
+	with db.cursor() as con:
+		con.execute("""SELECT id, config FROM guild_configs WHERE parsed IS NULL;""")
+		rows = con.fetchall()
+
+		for gid, config in rows:
+			try:
+				parsed = parse_config(config)
+
+			except:
+				app.log.warn(f"Couldn't migrate the config for {gid}, it isn't valid yaml.")
+				continue
+
+			con.execute("""UPDATE guild_configs SET parsed = %(parsed)s WHERE id = %(gid)s;""", dict(
+				parsed=parsed,
+				gid=gid
+			))
+
+	if rows:
+		app.log.info(f"Migrated {len(rows)} guild configs to their pre-parsed form.")
+
 def require_auth(func):
 	@wraps(func)
 	def wrapper(*args, **kwargs):
@@ -30,23 +70,18 @@ def require_guild(discord, gid, require_edit=False):
 				return g
 
 			with app.db.cursor() as con:
-				query = """SELECT config FROM guild_configs
+				query = """SELECT parsed FROM guild_configs
 						   WHERE id = %(gid)s;"""
 
 				con.execute(query, dict(gid=gid))
 				result = con.fetchone()
-				if result is None:
+				if result is None or result[0] is None:
 					return
 
-				result = result[0]
-
-				try:
-					web_config = safe_load(result).get("web", {})
-					
-				except:
-					web_config = {}
+				# psycopg2 decodes jsonb for us, the user IDs come back as string keys
+				web_config = result[0].get("web") or {}
 
-				web_access = web_config.get(int(discord.user.get("id")))
+				web_access = web_config.get(discord.user.get("id"))
 				if web_access is None:
 					return
 
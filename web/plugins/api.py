@@ -3,11 +3,10 @@ import os
 import ext.state as state
 
 from flask import jsonify, redirect, request, session
-from yaml import safe_load
 
 from ext.models import CLIENT_ID, OAuth2Handler
 from ext.state import app
-from ext.utils import require_auth, require_guild
+from ext.utils import parse_config, require_auth, require_guild
 
 BASE = "/api"
 INVITE_BASE = "https://discord.com/api/oauth2/authorize?client_id={client_id}&permissions={perms}&scope=bot"
@@ -67,7 +66,7 @@ def update_config(discord, gid):
 	updated_config = request.json.get("newConfig")
 
 	try:
-		safe_load(updated_config)
+		parsed = parse_config(updated_config)
 
 	except:
 		return jsonify({
@@ -76,17 +75,21 @@ def update_config(discord, gid):
 		})
 
 	with app.db.cursor() as con:
-		query = """INSERT INTO guild_configs (id, config)
-				   VALUES (%(id)s, %(config)s)
+		query = """INSERT INTO guild_configs (id, config, parsed)
+				   VALUES (%(id)s, %(config)s, %(parsed)s)
 				   ON CONFLICT (id) DO UPDATE
-				   SET config = %(config)s
+				   SET config = %(config)s, parsed = %(parsed)s
 				   WHERE guild_configs.id = %(id)s;"""
 
 		con.execute(query, dict(
 			id=gid, 
-			config=updated_config
+			config=updated_config,
+			parsed=parsed
 		))
 
+		# tell the bot to drop its cached copy of the guild's config
+		con.execute("""SELECT pg_notify('guild_configs', %(id)s);""", dict(id=gid))
+
 		return jsonify({
 			"code": 200,
 			"message": "Configuration successfully updated."
@@ -19,7 +19,8 @@ try:
 	db.set_session(autocommit=True)
 
 	with db.cursor() as con:
-		queries = """CREATE TABLE IF NOT EXISTS guild_configs (id BIGINT UNIQUE, config TEXT);""",
+		queries = ("""CREATE TABLE IF NOT EXISTS guild_configs (id BIGINT UNIQUE, config TEXT);""",
+				   """ALTER TABLE guild_configs ADD COLUMN IF NOT EXISTS parsed JSONB;""")
 
 		for query in queries:
 			con.execute(query)
@@ -34,6 +35,10 @@ except:
 
 app.log.info("Running {0.name} v{0.major}.{0.minor}.{0.patch}-{0.release}".format(VERSION))
 
+from ext.utils import migrate_configs
+
+migrate_configs(db)
+
 import plugins.api, plugins.ui
 
 app.boot()
\ No newline at end of file